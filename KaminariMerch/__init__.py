@@ -1,36 +1,69 @@
-from os import path
+from os import environ, path
 
-from flask import Flask, render_template, redirect, session, request, jsonify, abort, url_for
+import click
+from flask import Flask, render_template, redirect, request, jsonify, abort, url_for, send_from_directory
+from htmlmin import minify
+from markupsafe import Markup
 from flask_admin import Admin
 from flask_admin.menu import MenuLink
 from flask_qrcode import QRcode
 from flask_htmlmin import HTMLMIN
 from flask_socketio import SocketIO, join_room
+from flask_migrate import Migrate, upgrade
 
 from flask_security.utils import hash_password, verify_password
 from flask_security import Security, SQLAlchemyUserDatastore, url_for_security, LoginForm, login_required, current_user
 
-from KaminariMerch.models import User, Order, Product, Role, db
+from KaminariMerch.api import api
+from KaminariMerch.assets import AssetFingerprints
+from KaminariMerch.cart import Cart, create_cart_store
+from KaminariMerch.models import User, Order, Product, Role, WebhookEvent, db, strike, catalog_cache, \
+    engine_options, configure_engine
 from KaminariMerch.forms import DeleteAccountForm, PasswordResetForm
-from KaminariMerch.utils import generate_example_products, in_cart, add_product_to_cart, remove_product_from_cart
-from KaminariMerch.views import IndexView, UserView, OrderView, ProductView
+from KaminariMerch.utils import generate_example_products, seed_example_users, create_admin
+from KaminariMerch.views import IndexView, UserView, OrderView, ProductView, SalesView
+from KaminariMerch.notifier import PaymentNotifier
+from KaminariMerch.pricing import price_cart
+from KaminariMerch.images import ImagePipeline
+from KaminariMerch.qr import QRCodeStore
+from KaminariMerch.ratelimit import create_rate_limiter
+from KaminariMerch.reconciler import PaymentReconciler
+from KaminariMerch.signals import order_paid, product_images_changed
+from KaminariMerch.webhooks import WebhookQueueWorker
 
 appdir = path.abspath(path.dirname(__file__))
 imagedir = path.join(appdir, 'static/images')
+migrationsdir = path.join(path.dirname(appdir), 'migrations')
 
 
-def create_app(environment=None):
+def create_app(environment=None, config=None):
+
+    # Commands and servers that create the app without arguments pick the environment up from outside.
+    environment = environment or environ.get('KAMINARI_ENV')
 
     app = Flask(__name__)
     app.config.from_object('config')
     app.config['ENVIRONMENT'] = environment
 
+    # Layers the environment's settings, e.g. config.Production, over the defaults.
+    if environment:
+        app.config.from_object('config.' + environment.capitalize())
+
+    # Anything passed in directly, such as a test database, wins over both.
+    if config:
+        app.config.update(config)
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
     # Wraps app in useful helpers.
     QRcode(app)
-    HTMLMIN(app)
+    htmlmin = HTMLMIN(app)
+    assets = AssetFingerprints(app)
 
     # Initialize's database and user datastores.
     db.init_app(app)
+    configure_engine(app)
+    Migrate(app, db, directory=migrationsdir, render_as_batch=True)
     user_datastore = SQLAlchemyUserDatastore(db, User, Role)
     Security(app, user_datastore)
 
@@ -47,6 +80,61 @@ def create_app(environment=None):
     admin.add_link(MenuLink(name='Home', endpoint='store_page'))
     admin.add_view(ProductView(session=db.session, name='Products', endpoint='products', model=Product))
     admin.add_view(UserView(session=db.session, name='Users', endpoint='users', model=User))
+    admin.add_view(SalesView(days=app.config['SALES_REPORT_DAYS'], name='Sales', endpoint='sales'))
+
+    # Keeps shopping carts on the server so the session cookie stays small.
+    cart_store = create_cart_store(app.config)
+    cart_store.start_sweeper(app.config['CART_SWEEP_INTERVAL'])
+    app.extensions['cart_store'] = cart_store
+
+    # Stops any one client from using up our Strike quota or the cart endpoints.
+    rate_limiter = create_rate_limiter(app.config)
+    app.extensions['rate_limiter'] = rate_limiter
+
+    # Keeps payment status in sync with Strike in the background.
+    if app.config['RECONCILE_PAYMENTS']:
+        reconciler = PaymentReconciler(
+            app,
+            strike,
+            interval=app.config['RECONCILE_INTERVAL'],
+            page_size=app.config['RECONCILE_PAGE_SIZE'],
+            max_pages=app.config['RECONCILE_MAX_PAGES'],
+            invoice_expiry=app.config['STRIKE_INVOICE_EXPIRY']
+        )
+        reconciler.start()
+        app.extensions['payment_reconciler'] = reconciler
+
+    # Verifies queued payment webhooks in the background.
+    webhook_worker = WebhookQueueWorker(
+        app,
+        interval=app.config['WEBHOOK_WORKER_INTERVAL'],
+        batch_size=app.config['WEBHOOK_BATCH_SIZE'],
+        max_attempts=app.config['WEBHOOK_MAX_ATTEMPTS'],
+        retry_backoff=app.config['WEBHOOK_RETRY_BACKOFF']
+    )
+    webhook_worker.start()
+    app.extensions['webhook_worker'] = webhook_worker
+
+    # Wakes up requests waiting on an order as soon as it's paid.
+    payment_notifier = PaymentNotifier()
+    order_paid.connect(payment_notifier.notify, weak=False)
+    app.extensions['payment_notifier'] = payment_notifier
+
+    # Renders thumbnails and responsive copies of product images off-request.
+    image_pipeline = ImagePipeline(
+        widths=app.config['IMAGE_WIDTHS'],
+        quality=app.config['IMAGE_QUALITY'],
+        workers=app.config['IMAGE_WORKERS']
+    )
+    product_images_changed.connect(image_pipeline.on_images_changed, weak=False)
+    app.extensions['image_pipeline'] = image_pipeline
+
+    # Keeps rendered payment QR codes on disk.
+    qr_codes = QRCodeStore(app, app.config['QR_CODE_DIR'], workers=app.config['QR_CODE_WORKERS'])
+    app.extensions['qr_codes'] = qr_codes
+
+    # Read-only JSON API for products and orders.
+    app.register_blueprint(api)
 
     # Passes the login form to templates.
     @app.context_processor
@@ -56,8 +144,24 @@ def create_app(environment=None):
             'login_user_form': LoginForm(),
         }
 
+    def render_product_grid(cart):
+
+        """
+        Renders the store's product grid, minified ahead of time so it can be cached.
+        """
+
+        html = render_template('components/product_grid.html', products=Product.active_catalog(), cart=cart)
+
+        if app.config['MINIFY_PAGE']:
+            html = minify(html, remove_comments=True, reduce_empty_attributes=True)
+
+        return html
+
+    # The product grid, nearly all of this page, is cached already minified so the
+    # page skips the per-response minifier.
     @app.route('/')
     @app.route('/index')
+    @htmlmin.exempt
     def store_page():
 
         """
@@ -65,16 +169,17 @@ def create_app(environment=None):
         This is where users add items to their cart.
         """
 
-        products = Product.query.all()
+        cart = Cart.load()
 
-        if 'cart' not in session:
-            session['cart'] = []
+        # The product grid only changes with the catalog, login state and cart contents.
+        if current_user.is_authenticated:
+            key = ('product_grid', True, cart.serialize())
+        else:
+            key = ('product_grid', False, None)
 
-        for item in products:
-            if not item.active:
-                products.remove(item)
+        product_grid = catalog_cache.get_or_load(key, lambda: render_product_grid(cart))
 
-        return render_template('index.html', products=products, cart=session['cart'], in_cart=in_cart)
+        return render_template('index.html', product_grid=Markup(product_grid))
 
     @app.route('/cart')
     def shopping_cart():
@@ -84,51 +189,112 @@ def create_app(environment=None):
         an order before payment.
         """
 
-        total = 0
+        quote = price_cart(Cart.load())
 
-        if 'cart' in session:
-            products = Product.query.filter(Product.id.in_(session['cart'])).all()
-            for product in products:
-                total += product.price
-        else:
-            products = []
-
-        return render_template('cart.html', cart=products, total=total)
+        return render_template('cart.html', cart=quote.items, total=quote.total)
 
     @app.route('/add_to_cart', methods=['POST'])
     @login_required
+    @rate_limiter.limit('add_to_cart')
     def add_to_cart():
 
         """
-        API endpoint that adds an item to the request session using
+        API endpoint that adds an item to the user's cart using
         a provided Product ID.
         """
 
-        product = Product.query.get(request.form['id'])
+        product = Product.query.get_or_404(request.form['id'])
+        cart = Cart.load()
 
-        if not any(str(product.id) in d for d in session['cart']):
-            add_product_to_cart(product)
+        if product.id not in cart:
+            cart.add(product.id)
+            cart.save()
 
         return jsonify({'success': True})
 
     @app.route('/remove_from_cart', methods=['POST'])
     @login_required
+    @rate_limiter.limit('remove_from_cart')
     def remove_from_cart():
 
         """
-        API endpoint that removes an item from the request session using a
+        API endpoint that removes an item from the user's cart using a
         provided Product ID.
         """
 
-        product = Product.query.get(request.form['id'])
+        product = Product.query.get_or_404(request.form['id'])
+        cart = Cart.load()
 
-        if any(str(product.id) in d for d in session['cart']):
-            remove_product_from_cart(product)
+        if product.id in cart:
+            cart.remove(product.id)
+            cart.save()
 
         return jsonify({'success': True})
 
+    @app.route('/update_cart', methods=['POST'])
+    @login_required
+    @rate_limiter.limit('update_cart')
+    def update_cart():
+
+        """
+        API endpoint that applies a batch of cart changes at once. Takes a JSON body like
+        {"operations": [{"op": "add", "id": 1, "quantity": 2}, {"op": "remove", "id": 3}]}.
+        Either every operation is applied or none are. Returns the new cart and its total.
+        """
+
+        body = request.get_json(silent=True) or {}
+        operations = body.get('operations')
+
+        if not isinstance(operations, list):
+            return jsonify({'success': False, 'error': 'Expected a list of operations.'}), 400
+
+        cart = Cart.load()
+        changes = []
+
+        for operation in operations:
+            try:
+                op = operation['op']
+                product_id = int(operation['id'])
+                quantity = operation.get('quantity')
+                quantity = None if quantity is None else int(quantity)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                return jsonify({'success': False, 'error': 'Malformed operation.'}), 400
+
+            if op not in ('add', 'remove') or (quantity is not None and quantity < 1):
+                return jsonify({'success': False, 'error': 'Malformed operation.'}), 400
+
+            changes.append((op, product_id, quantity))
+
+        # Products being added are checked with one query for just their ids.
+        added = set(product_id for op, product_id, _ in changes if op == 'add')
+        active = set(product_id for (product_id,) in db.session.query(Product.id).filter(
+            Product.id.in_(added),
+            Product.active.is_(True)
+        )) if added else set()
+
+        for op, product_id, quantity in changes:
+
+            if op == 'add':
+                if product_id not in active:
+                    return jsonify({'success': False, 'error': 'Unknown product {}.'.format(product_id)}), 400
+                cart.add(product_id, quantity or 1)
+
+            elif product_id in cart:
+                cart.remove(product_id, quantity)
+
+        cart.save()
+
+        quote = price_cart(cart)
+
+        return jsonify({
+            'success': True,
+            'cart': [item._asdict() for item in quote],
+            'total': quote.total,
+        })
+
     @app.route('/check_payment', methods=['POST'])
     @login_required
+    @rate_limiter.limit('check_payment')
     def check_payment():
 
         """
@@ -137,7 +303,10 @@ def create_app(environment=None):
         """
 
         order = Order.query.get(request.form['id'])
-        return jsonify({'paid': order.check_paid()})
+        paid = order.check_paid()
+        db.session.commit()
+
+        return jsonify({'paid': paid})
 
     @app.route('/settings', methods=['GET', 'POST'])
     @login_required
@@ -173,6 +342,7 @@ def create_app(environment=None):
         )
 
     @app.route('/checkout')
+    @rate_limiter.limit('checkout')
     def checkout():
 
         """
@@ -180,8 +350,15 @@ def create_app(environment=None):
         order was successful then we redirect the user to it.
         """
 
-        products = Product.query.filter(Product.id.in_(session['cart'])).all()
-        order = current_user.create_order(products)
+        # Priced once, the order is built from this snapshot.
+        quote = price_cart(Cart.load())
+
+        if not quote:
+            return redirect(url_for('shopping_cart'))
+
+        # Goes straight to the pooled client, the async client's threads are kept for
+        # background batches so checkouts never queue behind them.
+        order = current_user.create_order(quote)
 
         # Checks to make sure the order actually was created. It's possible for this
         # to fail in certain edge cases.
@@ -190,7 +367,9 @@ def create_app(environment=None):
             db.session.add(order)
             db.session.commit()
 
-            session['cart'] = []
+            qr_codes.schedule(order.charge_id, order.payment_request)
+
+            Cart().save()
 
             return redirect(url_for('show_order', order_id=order.id))
 
@@ -212,12 +391,62 @@ def create_app(environment=None):
 
             if not order.paid:
                 order.check_paid()
+                db.session.commit()
 
             return render_template('order.html', order=order)
 
         else:
             return abort(404)
 
+    @app.route('/order/<int:order_id>/status')
+    @login_required
+    def order_status(order_id):
+
+        """
+        Long-polling payment status endpoint for orders. Waits up to `wait` seconds for the
+        order to be paid before answering. Answers come from the database and the payment
+        notifier, so any number of waiting clients never cause a request to Strike.
+        """
+
+        if not any(order_id in i for i in current_user.get_order_ids()):
+            return abort(404)
+
+        wait = min(request.args.get('wait', 0, type=int), app.config['ORDER_STATUS_MAX_WAIT'])
+
+        with payment_notifier.listen(order_id) as paid_event:
+
+            paid = bool(db.session.query(Order.paid).filter(Order.id == order_id).scalar())
+
+            if not paid and wait > 0:
+                # Hands the database connection back to the pool while waiting.
+                db.session.rollback()
+                paid = paid_event.wait(wait)
+
+        return jsonify({'paid': paid})
+
+    @app.route('/qr/<charge_id>.png')
+    @login_required
+    def order_qr_code(charge_id):
+
+        """
+        Serves the QR code for a charge's payment request to the user who placed the order.
+        These never change, so they're cached by the user's browser for good and revalidated
+        with an ETag. Codes that haven't been rendered yet are rendered on the spot.
+        """
+
+        order = Order.query.filter_by(charge_id=charge_id).first_or_404()
+
+        if order.user_id != current_user.id:
+            abort(404)
+
+        if not qr_codes.exists(charge_id):
+            qr_codes.generate(order.charge_id, order.payment_request)
+
+        response = send_from_directory(qr_codes.directory, qr_codes.filename(charge_id), conditional=True)
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+
+        return response
+
     @app.route('/confirm_payment', methods=['POST'])
     def payment_webhook():
 
@@ -225,19 +454,26 @@ def create_app(environment=None):
         This is a payment webhook that triggers when a payment is received.
 
         Because this webhook isn't authenticated, we don't trust the payment information on its own.
-        We check the payment status ourselves before updating.
+        Deliveries are only queued here, the webhook worker checks the payment status with Strike
+        itself before updating, retrying lookups that fail, and the reconciler catches anything
+        left over. Deliveries are acknowledged with a 202 once queued so Strike doesn't resend
+        them, or with a 200 when the order is already known to be paid.
         """
 
-        charge = request.get_json()
-        charge_id = charge['data']['id']
-        order = Order.query.filter_by(charge_id=charge_id).first()
+        payload = request.get_json(silent=True) or {}
 
-        if order:
-            order.check_paid()
-            if order.paid:
-                return jsonify({'success': True}), 200, {'ContentType': 'application/json'}
+        try:
+            charge_id = str(payload['data']['id'])
+        except (KeyError, TypeError):
+            return jsonify({'success': False}), 400, {'ContentType': 'application/json'}
+
+        if Order.query.filter(Order.charge_id == charge_id, Order.paid.is_(True)).count():
+            return jsonify({'success': True}), 200, {'ContentType': 'application/json'}
 
-        return jsonify({'success': False}), 400, {'ContentType': 'application/json'}
+        if WebhookEvent.enqueue(charge_id, str(payload.get('event', 'charge.succeeded'))):
+            webhook_worker.wake()
+
+        return jsonify({'success': True, 'queued': True}), 202, {'ContentType': 'application/json'}
 
     @app.route('/example_products')
     @login_required
@@ -253,36 +489,47 @@ def create_app(environment=None):
         else:
             return abort(404)
 
-    @app.before_first_request
-    def before_first_request():
+    @app.cli.command('seed')
+    def seed_command():
 
-        # This is just an example setup for the database.
-        # Obviously if we run in production this would be replaced
-        # with something a little less archaic. It works for now though.
+        """
+        Creates the admin role and the example accounts, skipping any that already exist.
+        """
 
-        # Create a cart in the session
-        if 'cart' not in session:
-            session['cart'] = []
+        seed_example_users(user_datastore)
 
-        # Clean out the database if we have to
-        db.drop_all()
+    @app.cli.command('compress-assets')
+    def compress_assets_command():
 
-        # Create any database tables that don't exist yet.
-        db.create_all()
+        """
+        Precompresses the static CSS and JS so they can be served without compressing per request.
+        """
 
-        # Create the Role "admin" -- unless it already exists
-        user_datastore.find_or_create_role(name='admin', description='Administrator')
+        click.echo('Wrote {} compressed files.'.format(assets.compress()))
 
-        # Create two Users for testing purposes -- unless they already exists.
-        # In each case, use Flask-Security utility function to encrypt the password.
-        user_datastore.create_user(email='someone@example.com', password=hash_password('password'))
-        user_datastore.create_user(email='admin@example.com', password=hash_password('password'))
+    @app.cli.command('bootstrap')
+    @click.option('--admin-email', envvar='ADMIN_EMAIL', help='Creates this admin account if it doesn\'t exist.')
+    @click.option('--admin-password', envvar='ADMIN_PASSWORD', help='Password for a newly created admin account.')
+    def bootstrap_command(admin_email, admin_password):
 
-        # Commit any database changes; the User and Roles must exist before we can add a Role to the User
-        db.session.commit()
+        """
+        Migrates the database to the latest schema. Run this once per deploy. The example
+        accounts are never created here, use `flask seed` for those in development.
+        """
 
-        user_datastore.add_role_to_user('admin@example.com', 'admin')
-        db.session.commit()
+        upgrade(directory=migrationsdir)
+
+        if admin_email:
+            if not admin_password:
+                raise click.UsageError('An admin password is needed along with the admin email.')
+            create_admin(user_datastore, admin_email, admin_password)
+
+    # Development convenience only, production runs `flask bootstrap` as a deploy
+    # step so requests never wait on schema work or password hashing.
+    if app.config['BOOTSTRAP_ON_STARTUP']:
+        with app.app_context():
+            upgrade(directory=migrationsdir)
+            seed_example_users(user_datastore)
 
     return app
 
@@ -297,37 +544,56 @@ def create_socketed_app(environment=None):
     """
 
     app = create_app(environment)
-    socket = SocketIO(app)
+
+    # With a message queue, a payment confirmed by any worker process reaches
+    # clients connected to every other one.
+    socket = SocketIO(
+        app,
+        message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+        channel=app.config['SOCKETIO_CHANNEL']
+    )
 
     @socket.on('subscribe')
     def subscribe_webhook(data):
 
         """
         Subscribes a user to a websocket room to make it easier to
-        notify of successful payments.
+        notify of successful payments. Users can only subscribe to their own orders.
         """
 
-        join_room(data['order'])
+        if not current_user.is_authenticated:
+            return False
 
-    @app.route('/confirm_payment_socket', methods=['POST'])
-    def payment_webhook_socket():
+        try:
+            order_id = int(data['order'])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        if not any(order_id in i for i in current_user.get_order_ids()):
+            return False
+
+        join_room(str(order_id))
+        return True
+
+    def confirm_payments(_sender, order_ids):
 
         """
-        This is an extended webhook that includes websockets.
-        From here we can send out a message to the user telling them that their payment's
-        been received and the order was successful.
+        Sends out a message to the users of newly paid orders telling them that their
+        payment's been received and the order was successful. Fires however the payment
+        was found, be it a webhook, the reconciler or a manual check.
         """
 
-        charge = request.get_json()
-        charge_id = charge['data']['id']
-        order = Order.query.filter_by(charge_id=charge_id).first()
+        for order_id in order_ids:
+            socket.emit('confirm_payment', True, room=str(order_id))
 
-        if order:
-            order.check_paid()
-            if order.paid:
-                socket.emit('confirm_payment', True, room=order.id)
-                return jsonify({'success': True}), 200, {'ContentType': 'application/json'}
+    order_paid.connect(confirm_payments, weak=False)
 
-        return jsonify({'success': False}), 400, {'ContentType': 'application/json'}
+    # Kept for Strike accounts that were set up with the old websocket webhook address.
+    app.add_url_rule(
+        '/confirm_payment_socket',
+        'payment_webhook_socket',
+        app.view_functions['payment_webhook'],
+        methods=['POST']
+    )
 
     return app, socket
@@ -0,0 +1,145 @@
+from flask import Blueprint, abort, current_app, jsonify, request
+from flask_security import current_user, login_required
+
+from KaminariMerch.models import Order, Product, User, db, order_products
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+PRODUCT_FIELDS = ('id', 'name', 'description', 'price', 'image', 'active')
+ORDER_FIELDS = ('id', 'user_id', 'description', 'charge_id', 'total_cost', 'payment_request', 'paid', 'lines')
+
+
+def order_lines(order_ids):
+
+    """
+    Loads the lines of a page of orders with a single query, keyed by order id.
+    """
+
+    lines = {}
+
+    rows = db.session.query(
+        order_products.c.order_id,
+        order_products.c.product_id,
+        order_products.c.quantity,
+        order_products.c.unit_price
+    ).filter(order_products.c.order_id.in_(order_ids)).order_by(order_products.c.order_id, order_products.c.product_id)
+
+    for order_id, product_id, quantity, unit_price in rows:
+        lines.setdefault(order_id, []).append({
+            'product_id': product_id,
+            'quantity': quantity,
+            'unit_price': unit_price,
+        })
+
+    return lines
+
+
+# Fields that aren't columns, each loaded for a whole page at once.
+ORDER_RELATED = {'lines': order_lines}
+
+
+def _selected_fields(allowed):
+
+    """
+    Returns the fields asked for with ?fields=a,b,c, or every allowed field. The id is
+    always included since it's the pagination cursor.
+    """
+
+    requested = request.args.get('fields')
+
+    if not requested:
+        return list(allowed)
+
+    fields = [field for field in requested.split(',') if field]
+    unknown = [field for field in fields if field not in allowed]
+
+    if unknown:
+        abort(400, 'Unknown fields: {}'.format(', '.join(unknown)))
+
+    return ['id'] + [field for field in fields if field != 'id']
+
+
+def keyset_page(model, query, allowed_fields, related=None):
+
+    """
+    Answers with one page of a query using keyset pagination on id. Pass ?after=<id>,
+    the previous page's `next`, to get the following page, so deep pages cost the same
+    as the first one. Responses carry an ETag and honour If-None-Match. Related maps
+    fields that aren't columns to a function loading them for a list of ids.
+    """
+
+    related = related or {}
+    fields = _selected_fields(allowed_fields)
+    columns = [field for field in fields if field not in related]
+    limit = max(1, min(request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int),
+                       current_app.config['API_MAX_PAGE_SIZE']))
+    after = request.args.get('after', type=int)
+
+    if after is not None:
+        query = query.filter(model.id > after)
+
+    rows = query.with_entities(*[getattr(model, field) for field in columns]).order_by(model.id).limit(limit + 1).all()
+    items = [dict(zip(columns, row)) for row in rows[:limit]]
+
+    for field in fields:
+        if field in related:
+            values = related[field]([item['id'] for item in items]) if items else {}
+            for item in items:
+                item[field] = values.get(item['id'], [])
+
+    response = jsonify({
+        'items': items,
+        'next': items[-1]['id'] if len(rows) > limit else None,
+    })
+    response.add_etag()
+
+    return response.make_conditional(request)
+
+
+@api.route('/products')
+def products():
+
+    """
+    The store's active products.
+    """
+
+    return keyset_page(Product, Product.query.filter(Product.active.is_(True)), PRODUCT_FIELDS)
+
+
+@api.route('/orders')
+@login_required
+def orders():
+
+    """
+    The signed in user's own orders.
+    """
+
+    return keyset_page(Order, Order.query.filter(Order.user_id == current_user.id), ORDER_FIELDS, ORDER_RELATED)
+
+
+@api.route('/admin/orders')
+@login_required
+def admin_orders():
+
+    """
+    Searches every order. Filter with ?paid=true|false, ?user_id=<id> or ?email=<address>.
+    """
+
+    if not current_user.has_role('admin'):
+        abort(403)
+
+    query = Order.query
+
+    paid = request.args.get('paid')
+    if paid is not None:
+        query = query.filter(Order.paid.is_(True)) if paid == 'true' else query.filter(Order.paid.isnot(True))
+
+    user_id = request.args.get('user_id', type=int)
+    if user_id is not None:
+        query = query.filter(Order.user_id == user_id)
+
+    email = request.args.get('email')
+    if email:
+        query = query.join(User, Order.user).filter(User.email == email)
+
+    return keyset_page(Order, query, ORDER_FIELDS, ORDER_RELATED)
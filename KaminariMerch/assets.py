@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from threading import Lock
+
+from flask import request, send_from_directory
+
+try:
+    from werkzeug.utils import safe_join
+except ImportError:
+    from werkzeug.security import safe_join
+
+# Served first to browsers that accept them, when found next to the original file
+# and no older than it.
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+# Only text assets are worth compressing ahead of time, images already are.
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.html', '.txt')
+
+
+def _is_current(compressed, original):
+    try:
+        return os.path.getmtime(compressed) >= os.path.getmtime(original)
+    except OSError:
+        return False
+
+
+class AssetFingerprints(object):
+
+    """
+    Adds a hash of the file's contents to every url_for('static', ...) URL, product
+    images included, and serves those URLs with a year-long immutable cache. A changed
+    file gets a new URL, so browsers never need to revalidate. Precompressed .br and
+    .gz copies are served instead of the original when the browser accepts them.
+    """
+
+    def __init__(self, app=None):
+
+        self.static_folder = None
+        self._hashes = {}
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+
+        self.static_folder = app.static_folder
+
+        app.url_defaults(self.add_fingerprint)
+        app.view_functions['static'] = self.send_static_file
+        app.extensions['asset_fingerprints'] = self
+
+    def fingerprint(self, filename):
+
+        """
+        Returns a short hash of a static file's contents, or None if there's no such file.
+        Hashes are kept until the file's size or modification time changes.
+        """
+
+        path = safe_join(self.static_folder, filename)
+
+        try:
+            stat = os.stat(path)
+        except (TypeError, OSError):
+            return None
+
+        key = (stat.st_mtime, stat.st_size)
+
+        with self._lock:
+            cached = self._hashes.get(path)
+
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.md5()
+
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(65536), b''):
+                digest.update(chunk)
+
+        fingerprint = digest.hexdigest()[:12]
+
+        with self._lock:
+            self._hashes[path] = (key, fingerprint)
+
+        return fingerprint
+
+    def add_fingerprint(self, endpoint, values):
+
+        if endpoint != 'static' or 'filename' not in values or 'v' in values:
+            return
+
+        fingerprint = self.fingerprint(values['filename'])
+
+        if fingerprint is not None:
+            values['v'] = fingerprint
+
+    def send_static_file(self, filename):
+
+        response = None
+        original = safe_join(self.static_folder, filename)
+
+        for encoding, extension in PRECOMPRESSED:
+
+            if encoding not in request.accept_encodings:
+                continue
+
+            path = safe_join(self.static_folder, filename + extension)
+
+            # A copy older than the file was compressed before the last edit, skip it.
+            if path is not None and os.path.isfile(path) and _is_current(path, original):
+                response = send_from_directory(
+                    self.static_folder,
+                    filename + extension,
+                    mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                    conditional=True
+                )
+                response.headers['Content-Encoding'] = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(self.static_folder, filename, conditional=True)
+
+        response.vary.add('Accept-Encoding')
+
+        # Only a URL that carries the file's current hash can be cached for good.
+        if request.args.get('v') and request.args.get('v') == self.fingerprint(filename):
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+        return response
+
+    def compress(self):
+
+        """
+        Writes .gz copies, and .br copies when the brotli package is installed, of the
+        text assets in the static folder. Returns how many files were written.
+        """
+
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+
+        written = 0
+
+        for directory, _, filenames in os.walk(self.static_folder):
+            for filename in filenames:
+
+                if not filename.endswith(COMPRESSIBLE):
+                    continue
+
+                path = os.path.join(directory, filename)
+
+                with open(path, 'rb') as file:
+                    data = file.read()
+
+                with open(path + '.gz', 'wb') as file:
+                    file.write(gzip.compress(data, 9))
+                written += 1
+
+                if brotli is not None:
+                    with open(path + '.br', 'wb') as file:
+                        file.write(brotli.compress(data))
+                    written += 1
+
+        return written
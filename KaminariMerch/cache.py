@@ -0,0 +1,154 @@
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+_DEFAULT = object()
+
+
+class _Pending(object):
+
+    """
+    A load that is currently in progress, other callers for the same key wait on it.
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+class TTLCache(object):
+
+    """
+    Small thread-safe LRU cache where entries expire after a time-to-live.
+    Entries stored with a ttl of None never expire, but can still be evicted
+    once the cache is full.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key, default):
+
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return default
+
+        value, expires = entry
+
+        if expires is not None and expires <= time.time():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._lookup(key, default)
+
+    def set(self, key, value, ttl=_DEFAULT):
+
+        ttl = self.ttl if ttl is _DEFAULT else ttl
+        expires = None if ttl is None else time.time() + ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_load(self, key, loader, ttl=_DEFAULT):
+
+        """
+        Returns the cached value for a key, calling loader() on a miss. Concurrent
+        misses for the same key share a single loader call. The ttl can be a function
+        of the loaded value, and loaded values of None are not cached.
+        """
+
+        with self._lock:
+
+            value = self._lookup(key, _DEFAULT)
+
+            if value is not _DEFAULT:
+                return value
+
+            pending = self._pending.get(key)
+
+            if pending is not None:
+                owner = False
+            else:
+                owner = True
+                pending = self._pending[key] = _Pending()
+
+        if not owner:
+            return pending.wait()
+
+        try:
+            value = loader()
+            if value is not None:
+                self.set(key, value, ttl(value) if callable(ttl) else ttl)
+            pending.value = value
+        except Exception as error:
+            pending.error = error
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.done.set()
+
+        return value
+
+
+class ChargeStatusCache(object):
+
+    """
+    Caches Strike charges by their id so that repeated payment checks don't each
+    turn into a request to Strike. Unpaid charges are kept for a short time while
+    paid charges are kept until evicted, as a payment can't be undone.
+    """
+
+    def __init__(self, client, ttl=5, max_size=4096):
+
+        self.client = client
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def _ttl_for(self, charge):
+        return None if charge['paid'] else self._cache.ttl
+
+    def get(self, charge_id):
+        return self._cache.get_or_load(charge_id, lambda: self.client.get_charge(charge_id), ttl=self._ttl_for)
+
+    def put(self, charge):
+        self._cache.set(charge['id'], charge, self._ttl_for(charge))
+
+    def invalidate(self, charge_id):
+        self._cache.delete(charge_id)
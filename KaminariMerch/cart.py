@@ -0,0 +1,302 @@
+import sqlite3
+import time
+from threading import Event, Lock, Thread, local
+from uuid import uuid4
+
+from flask import current_app, session
+from flask_security import current_user
+
+
+def _cart_key(create=True):
+
+    """
+    Returns the key the current visitor's cart is stored under. Signed in users keep
+    their cart by user id, everyone else by a random token held in their session.
+    Visitors without a token only get one once there's something to store.
+    """
+
+    if current_user.is_authenticated:
+        return 'user:{}'.format(current_user.id)
+
+    if 'cart_token' not in session:
+        if not create:
+            return None
+        session['cart_token'] = uuid4().hex
+
+    return 'session:' + session['cart_token']
+
+
+class Cart(object):
+
+    """
+    A shopping cart mapping product ids to quantities. Membership checks are a
+    dictionary lookup rather than a scan over the cart.
+
+    Carts serialise to a short, stable string of comma separated ids sorted in
+    ascending order, with a quantity suffix only when more than one is wanted.
+    For example "3,7:2,12".
+    """
+
+    def __init__(self, items=None):
+        self.items = dict(items or {})
+
+    def __contains__(self, product_id):
+        try:
+            return int(product_id) in self.items
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return iter(sorted(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    @property
+    def product_ids(self):
+        return sorted(self.items)
+
+    def quantity(self, product_id):
+        return self.items.get(int(product_id), 0)
+
+    def add(self, product_id, quantity=1):
+        product_id = int(product_id)
+        self.items[product_id] = self.items.get(product_id, 0) + quantity
+
+    def remove(self, product_id, quantity=None):
+
+        """
+        Removes a quantity of a product from the cart, or all of it if no quantity is given.
+        """
+
+        product_id = int(product_id)
+        remaining = 0 if quantity is None else self.items.get(product_id, 0) - quantity
+
+        if remaining > 0:
+            self.items[product_id] = remaining
+        else:
+            self.items.pop(product_id, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def serialize(self):
+        return ','.join(
+            str(product_id) if quantity == 1 else '{}:{}'.format(product_id, quantity)
+            for product_id, quantity in sorted(self.items.items())
+        )
+
+    @classmethod
+    def deserialize(cls, data):
+
+        """
+        Builds a cart from its serialised form. Older sessions stored the cart as a
+        list of product id strings, those are still understood.
+        """
+
+        cart = cls()
+
+        if not data:
+            return cart
+
+        entries = data.split(',') if isinstance(data, str) else data
+
+        for entry in entries:
+            product_id, _, quantity = str(entry).partition(':')
+            try:
+                product_id, quantity = int(product_id), int(quantity or 1)
+            except ValueError:
+                continue
+
+            if quantity > 0:
+                cart.add(product_id, quantity)
+
+        return cart
+
+    @classmethod
+    def load(cls):
+
+        """
+        Returns the current visitor's cart from the app's cart store.
+        """
+
+        key = _cart_key(create=False)
+        data = current_app.extensions['cart_store'].load(key) if key else None
+
+        # Carts used to live in the session cookie, move any leftovers across.
+        if data is None and 'cart' in session:
+            cart = cls.deserialize(session.pop('cart'))
+            cart.save()
+            return cart
+
+        return cls.deserialize(data)
+
+    def save(self):
+
+        store = current_app.extensions['cart_store']
+
+        if self.items:
+            store.save(_cart_key(), self.serialize())
+        else:
+            key = _cart_key(create=False)
+            if key:
+                store.delete(key)
+
+
+class CartStore(object):
+
+    """
+    Base class for server-side cart storage. Carts are stored in their serialised
+    form under a key and expire once they haven't been saved for ttl seconds.
+    """
+
+    def __init__(self, ttl=604800):
+        self.ttl = ttl
+        self._stopped = Event()
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def save(self, key, data):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def sweep(self):
+
+        """
+        Removes every expired cart and returns how many were removed.
+        """
+
+        raise NotImplementedError
+
+    def start_sweeper(self, interval=600):
+
+        def run():
+            while not self._stopped.wait(interval):
+                self.sweep()
+
+        thread = Thread(target=run, name='cart-sweeper')
+        thread.daemon = True
+        thread.start()
+
+    def stop_sweeper(self):
+        self._stopped.set()
+
+
+class MemoryCartStore(CartStore):
+
+    """
+    Keeps carts in this process's memory. Carts are lost on restart and aren't
+    shared between worker processes, so this is mostly useful for development.
+    """
+
+    def __init__(self, ttl=604800):
+        super(MemoryCartStore, self).__init__(ttl)
+        self._carts = {}
+        self._lock = Lock()
+
+    def load(self, key):
+
+        with self._lock:
+            entry = self._carts.get(key)
+
+        if entry is None or entry[1] <= time.time():
+            return None
+
+        return entry[0]
+
+    def save(self, key, data):
+        with self._lock:
+            self._carts[key] = (data, time.time() + self.ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._carts.pop(key, None)
+
+    def sweep(self):
+
+        now = time.time()
+
+        with self._lock:
+            expired = [key for key, (_, expires) in self._carts.items() if expires <= now]
+            for key in expired:
+                del self._carts[key]
+
+        return len(expired)
+
+
+class SQLiteCartStore(CartStore):
+
+    """
+    Keeps carts in a table of their own SQLite database, separate from the main
+    database so cart writes never wait on order or payment transactions.
+    """
+
+    def __init__(self, path, ttl=604800):
+
+        super(SQLiteCartStore, self).__init__(ttl)
+        self.path = path
+        self._connections = local()
+
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cart ('
+                'key TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cart_expires ON cart (expires)')
+
+    def _connection(self):
+
+        # sqlite3 connections can't be shared between threads, so each thread gets its own.
+        connection = getattr(self._connections, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._connections.connection = connection
+
+        return connection
+
+    def load(self, key):
+
+        row = self._connection().execute(
+            'SELECT data FROM cart WHERE key = ? AND expires > ?',
+            (key, time.time())
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def save(self, key, data):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cart (key, data, expires) VALUES (?, ?, ?)',
+                (key, data, time.time() + self.ttl)
+            )
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cart WHERE key = ?', (key,))
+
+    def sweep(self):
+        with self._connection() as connection:
+            return connection.execute('DELETE FROM cart WHERE expires <= ?', (time.time(),)).rowcount
+
+
+def create_cart_store(config):
+
+    """
+    Creates the cart store selected by the CART_STORE setting.
+    """
+
+    if config['CART_STORE'] == 'memory':
+        return MemoryCartStore(ttl=config['CART_TTL'])
+
+    if config['CART_STORE'] == 'sqlite':
+        return SQLiteCartStore(config['CART_STORE_PATH'], ttl=config['CART_TTL'])
+
+    raise ValueError('Unknown cart store: {}'.format(config['CART_STORE']))
@@ -1,7 +1,11 @@
+from os import path
+
 from flask import url_for
 from flask_admin import form
 from markupsafe import Markup
 
+from KaminariMerch.images import imagedir
+
 
 def payment_status_formatter(_view, _context, model, name):
 
@@ -34,8 +38,14 @@ def product_image_formatter(_view, _context, model, _name):
     if not model.image:
         return 'No Image Available'
 
+    # The thumbnail is rendered in the background, so it may not be there just yet.
+    filename = form.thumbgen_filename(model.image)
+
+    if not path.exists(path.join(imagedir, filename)):
+        filename = model.image
+
     return Markup(
-        '<img src="{0}">'.format(
-            url_for('static', filename=form.thumbgen_filename('images/' + model.image))
+        '<img src="{0}" style="max-width: 200px;">'.format(
+            url_for('static', filename='images/' + filename)
         )
     )
@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from flask_admin.form import thumbgen_filename
+from PIL import Image, ImageOps
+
+from config import basedir
+
+imagedir = os.path.join(basedir, 'KaminariMerch/static/images')
+
+# Matches the admin's old ImageUploadField thumbnail, cropped to fill the box.
+THUMBNAIL_SIZE = (200, 200)
+
+
+def variant_filename(filename, width, extension=None):
+
+    """
+    Returns the filename of a resized copy of an uploaded image, e.g. abc_600w.webp.
+    """
+
+    stem, original_extension = os.path.splitext(filename)
+    return '{}_{}w{}'.format(stem, width, '.' + extension if extension else original_extension)
+
+
+def _save(image, target, image_format, quality):
+
+    # JPEGs have no alpha channel.
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    temporary = '{}.{}.tmp'.format(target, os.getpid())
+    image.save(temporary, format=image_format, quality=quality)
+    os.replace(temporary, target)
+
+
+def render_variants(directory, filename, widths, quality):
+
+    """
+    Renders the admin thumbnail and a resized copy of an uploaded image for every width
+    smaller than the original, both in the original format and as WebP. This runs in a
+    worker process, away from the request that uploaded the image.
+    """
+
+    with Image.open(os.path.join(directory, filename)) as original:
+
+        original.load()
+        image_format = original.format
+
+        thumbnail = ImageOps.fit(original, THUMBNAIL_SIZE, Image.LANCZOS)
+        _save(thumbnail, os.path.join(directory, thumbgen_filename(filename)), image_format, quality)
+
+        for width in widths:
+
+            if width >= original.width:
+                continue
+
+            height = int(round(original.height * width / float(original.width)))
+            resized = original.resize((width, height), Image.LANCZOS)
+
+            _save(resized, os.path.join(directory, variant_filename(filename, width)), image_format, quality)
+            _save(resized, os.path.join(directory, variant_filename(filename, width, 'webp')), 'WEBP', quality)
+
+
+def remove_variants(directory, filename, widths):
+
+    """
+    Deletes every file rendered from an uploaded image.
+    """
+
+    targets = [thumbgen_filename(filename)]
+
+    for width in widths:
+        targets.append(variant_filename(filename, width))
+        targets.append(variant_filename(filename, width, 'webp'))
+
+    for target in targets:
+        try:
+            os.remove(os.path.join(directory, target))
+        except OSError:
+            pass
+
+
+class ImagePipeline(object):
+
+    """
+    Renders responsive copies of product images in a pool of worker processes. The
+    pool is only started once there's something to render. By then the app is running
+    its background threads, so workers are spawned fresh rather than forked, a forked
+    child could inherit a lock one of those threads was holding and hang on it.
+    """
+
+    def __init__(self, directory=imagedir, widths=(300, 600, 1200), quality=80, workers=2):
+
+        self.directory = directory
+        self.widths = widths
+        self.quality = quality
+        self.workers = workers
+        self._executor = None
+        self._lock = Lock()
+
+    def submit(self, filename):
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+
+        return self._executor.submit(render_variants, self.directory, filename, self.widths, self.quality)
+
+    def on_images_changed(self, _sender=None, filenames=()):
+        for filename in filenames:
+            self.submit(filename)
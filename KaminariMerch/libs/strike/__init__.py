@@ -1 +1,2 @@
 from .strike import Strike
+from .aio import AsyncStrike
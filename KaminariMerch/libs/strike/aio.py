@@ -0,0 +1,36 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class AsyncStrike(object):
+
+    """
+    Asyncio variant of the Strike client. Calls are handed to the pooled sync
+    client on a bounded thread pool, so many charges can be created or fetched
+    at once without blocking the event loop and without ever having more than
+    max_in_flight requests open against Strike.
+    """
+
+    def __init__(self, client, max_in_flight=10):
+
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def call(self, func, *args, **kwargs):
+
+        """
+        Runs a blocking callable on the client's request pool and returns an awaitable
+        for its result, from within a running event loop. Useful for wrappers around the
+        sync client such as caches.
+        """
+
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def create_charge(self, amount, currency='btc', description='A Lightning Payment'):
+        return await self.call(self.client.create_charge, amount, currency, description)
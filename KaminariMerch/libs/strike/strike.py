@@ -1,27 +1,71 @@
-from requests import post, get
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
 import json
 
 
+def _retry_policy(retries, backoff):
+
+    """
+    Builds a retry policy that only retries idempotent GET requests. Connection
+    errors are still retried for every method since the request never left.
+    """
+
+    options = {
+        'total': retries,
+        'connect': retries,
+        'read': retries,
+        'status': retries,
+        'backoff_factor': backoff,
+        'status_forcelist': (500, 502, 503, 504),
+        'raise_on_status': False,
+    }
+
+    # urllib3 renamed method_whitelist to allowed_methods in 1.26.
+    try:
+        return Retry(allowed_methods=frozenset(['GET']), **options)
+    except TypeError:
+        return Retry(method_whitelist=frozenset(['GET']), **options)
+
+
 class Strike(object):
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, endpoint='https://api.dev.strike.acinq.co/api/v1', pool_size=10,
+                 connect_timeout=3.05, read_timeout=10, max_retries=3, retry_backoff=0.3):
 
         self.api_key = api_key
-        self.endpoint = "https://api.dev.strike.acinq.co/api/v1"
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+
+        # A single pooled session keeps TLS connections to Strike alive between calls.
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=_retry_policy(max_retries, retry_backoff)
+        )
+
+        self.session = Session()
+        self.session.auth = HTTPBasicAuth(self.api_key, '')
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def _request(self, method, url, data=None):
 
-        if method == 'POST':
-            response = post(self.endpoint + url, auth=HTTPBasicAuth(self.api_key, ''), data=data)
-        elif method == 'GET':
-            response = get(self.endpoint + url, auth=HTTPBasicAuth(self.api_key, ''))
-        else:
-            response = 'ERROR'  # TODO: This is makeshift error handling, do it properly.
+        if method not in ('POST', 'GET'):
+            raise ValueError('Unsupported Strike request method: {}'.format(method))
+
+        try:
+            response = self.session.request(method, self.endpoint + url, data=data, timeout=self.timeout)
+        except RequestException:
+            return None
 
         if response.ok:
             return json.loads(response.content)
 
+    def close(self):
+        self.session.close()
+
     def create_charge(self, amount, currency='btc', description='A Lightning Payment'):
 
         data = {
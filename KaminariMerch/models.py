@@ -1,29 +1,131 @@
+import asyncio
 import os
+from datetime import datetime, timedelta
+from itertools import chain
 
 from flask import url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_security import UserMixin, RoleMixin
-from sqlalchemy import event
-
-from KaminariMerch.libs.strike import Strike
-from config import STRIKE_API_KEY
+from sqlalchemy import bindparam, event, func, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload, subqueryload, lazyload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from KaminariMerch.cache import ChargeStatusCache, TTLCache
+from KaminariMerch.libs.strike import Strike, AsyncStrike
+from KaminariMerch.images import imagedir, variant_filename, remove_variants
+from KaminariMerch.signals import order_paid, product_images_changed
+from config import STRIKE_API_KEY, STRIKE_ENDPOINT, STRIKE_POOL_SIZE, STRIKE_CONNECT_TIMEOUT, \
+    STRIKE_READ_TIMEOUT, STRIKE_MAX_RETRIES, STRIKE_RETRY_BACKOFF, STRIKE_MAX_IN_FLIGHT, \
+    STRIKE_BACKGROUND_MAX_IN_FLIGHT, CHARGE_CACHE_TTL, CHARGE_CACHE_SIZE, CATALOG_CACHE_TTL, CATALOG_CACHE_SIZE, \
+    IMAGE_WIDTHS
+
+strike = Strike(
+    STRIKE_API_KEY,
+    endpoint=STRIKE_ENDPOINT,
+    pool_size=STRIKE_POOL_SIZE,
+    connect_timeout=STRIKE_CONNECT_TIMEOUT,
+    read_timeout=STRIKE_READ_TIMEOUT,
+    max_retries=STRIKE_MAX_RETRIES,
+    retry_backoff=STRIKE_RETRY_BACKOFF
+)
 
-strike = Strike(STRIKE_API_KEY)
+# Checkouts and payment checks awaited by an async server get their own budget, so
+# background batches such as webhook verification can never hold them up.
+async_strike = AsyncStrike(strike, max_in_flight=STRIKE_MAX_IN_FLIGHT)
+background_strike = AsyncStrike(strike, max_in_flight=STRIKE_BACKGROUND_MAX_IN_FLIGHT)
+charge_cache = ChargeStatusCache(strike, ttl=CHARGE_CACHE_TTL, max_size=CHARGE_CACHE_SIZE)
+catalog_cache = TTLCache(max_size=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
 db = SQLAlchemy()
 
+# Schema changes to these tables and models need a migration in migrations/versions.
 roles_users = db.Table(
     'roles_users',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('role_id', db.Integer, db.ForeignKey('role.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('role_id', db.Integer, db.ForeignKey('role.id'), primary_key=True)
 )
 
 order_products = db.Table(
     'order_products',
-    db.Column('order_id', db.Integer, db.ForeignKey('order.id')),
-    db.Column('product_id', db.Integer, db.ForeignKey('product.id'))
+    db.Column('order_id', db.Integer, db.ForeignKey('order.id'), primary_key=True),
+    db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True, index=True),
+    db.Column('quantity', db.Integer, nullable=False, default=1, server_default='1'),
+    db.Column('unit_price', db.Integer)
 )
 
 
+def engine_options(config):
+
+    """
+    Builds the SQLAlchemy engine options for the configured database. SQLite gets a
+    busy timeout, everything else gets a sized connection pool.
+    """
+
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT']}}
+
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+    }
+
+
+def configure_engine(app):
+
+    """
+    Switches SQLite connections over to write-ahead logging when enabled, so
+    readers don't block the writer and the writer doesn't block readers.
+    """
+
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') or not app.config['SQLITE_WAL']:
+        return
+
+    @event.listens_for(db.get_engine(app), 'connect')
+    def enable_wal(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
+LOADING_STRATEGIES = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'subquery': subqueryload,
+    'select': lazyload,
+}
+
+
+def eager_options(model, strategies=None):
+
+    """
+    Builds query options that load relationships up front. Strategies map a relationship
+    name to one of LOADING_STRATEGIES and default to the model's list_loading.
+    """
+
+    if strategies is None:
+        strategies = getattr(model, 'list_loading', {})
+
+    return [LOADING_STRATEGIES[strategy](getattr(model, name)) for name, strategy in strategies.items()]
+
+
+def order_description(items):
+
+    """
+    Returns the payment description displayed in wallets for a list of priced items.
+    """
+
+    # Generates payment text to be displayed in wallets.
+    description = ', '.join(
+        item.name if item.quantity == 1 else '{} x{}'.format(item.name, item.quantity)
+        for item in items
+    )
+
+    # Truncates payment description if it's too long.
+    return (description[:252] + '...') if len(description) > 256 else description
+
+
 class Role(db.Model, RoleMixin):
 
     id = db.Column(db.Integer, primary_key=True, unique=True)
@@ -52,45 +154,67 @@ class User(db.Model, UserMixin):
     )
     orders = db.relationship('Order', back_populates='user')
 
+    # How relationships are loaded when listing many users at once.
+    list_loading = {'roles': 'joined', 'orders': 'selectin'}
+
     def __repr__(self):
         return self.email
 
-    def create_order(self, products):
+    def create_order(self, quote):
 
-        total = 0
-        description = ''
+        description = order_description(quote)
+        charge = strike.create_charge(quote.total, 'btc', description)
 
-        # Generates payment text to be displayed in wallets.
-        for product in products:
-            total += product.price
-            if description:
-                description = description + ', ' + product.name
-            else:
-                description = product.name
+        return self._order_for_charge(quote, description, charge)
+
+    async def create_order_async(self, quote):
+
+        """
+        Same as create_order for servers running an event loop. The Strike request runs on
+        the async client's threads so the loop carries on meanwhile, the caller commits.
+        """
 
-        # Truncates payment description if it's too long.
-        description = (description[:252] + '...') if len(description) > 256 else description
+        description = order_description(quote)
+        charge = await async_strike.create_charge(quote.total, 'btc', description)
 
-        charge = strike.create_charge(total, 'btc', description)
+        return self._order_for_charge(quote, description, charge)
+
+    def _order_for_charge(self, quote, description, charge):
 
         # This should work most of the time but we check just in case.
         if charge:
 
-            return Order(
+            order = Order(
                 user_id=self.id,
                 user=self,
                 description=description,
-                total_cost=total,
-                products=products,
+                total_cost=quote.total,
                 charge_id=charge['id'],
                 payment_request=charge['payment_request']
             )
 
+            # Linked to the products by id when inserted, no need to load them. Each line
+            # keeps the quantity ordered and the unit price it was charged at.
+            order.pending_lines = [(item.id, item.quantity, item.price) for item in quote]
+
+            return order
+
         else:
             return None
 
-    def get_orders(self):
-        return Order.query.filter_by(user=self).all()
+    def get_orders(self, after=None, limit=None):
+
+        """
+        Returns the user's orders by id. Pass the last id seen as after, along with a
+        limit, to page through them without the cost of an offset.
+        """
+
+        query = Order.query.filter(Order.user_id == self.id)
+
+        if after is not None:
+            query = query.filter(Order.id > after)
+
+        return query.order_by(Order.id).limit(limit).all()
 
     def get_order_ids(self):
         return db.session.query(Order.id).filter(Order.user == self).all()
@@ -98,8 +222,13 @@ class User(db.Model, UserMixin):
 
 class Order(db.Model):
 
+    # Lets payment reconciliation find unpaid orders without scanning every order.
+    __table_args__ = (
+        db.Index('ix_order_paid_id', 'paid', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, unique=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     user = db.relationship('User', back_populates='orders')
     description = db.Column(db.String(256))
     charge_id = db.Column(db.String(64), unique=True)
@@ -111,21 +240,325 @@ class Order(db.Model):
         secondary=order_products,
         backref=db.backref('orders', lazy='dynamic')
     )
+    lines = db.relationship('OrderLine', viewonly=True, order_by='OrderLine.product_id')
+
+    # How relationships are loaded when listing many orders at once.
+    list_loading = {'user': 'joined', 'lines': 'selectin'}
 
     def __repr__(self):
         return 'Order #{}'.format(self.id)
 
+    @staticmethod
+    def fetch_paid(charge_id):
+
+        """
+        Asks Strike, through the charge cache, whether a charge has been paid.
+        Doesn't touch the database. A failed or timed out request counts as unpaid.
+        """
+
+        charge = charge_cache.get(charge_id)
+        return bool(charge and charge['paid'])
+
+    @staticmethod
+    async def fetch_charges(charge_ids):
+
+        """
+        Looks up many charges at once through the charge cache. Returns a dictionary of
+        charge ids to charges, with None for any lookup that failed.
+        """
+
+        charge_ids = list(charge_ids)
+        charges = await asyncio.gather(*[
+            background_strike.call(charge_cache.get, charge_id) for charge_id in charge_ids
+        ])
+
+        return dict(zip(charge_ids, charges))
+
+    @classmethod
+    def apply_paid(cls, order_ids, chunk_size=500):
+
+        """
+        Marks orders as paid, leaving alone any that are already paid. Returns the ids
+        of the orders this transaction actually flipped, the caller commits.
+        """
+
+        order_ids = list(order_ids)
+        changed = []
+
+        for start in range(0, len(order_ids), chunk_size):
+            flipped = cls._flip_paid(order_ids[start:start + chunk_size])
+            if flipped:
+                ProductSales.record(flipped)
+                changed.extend(flipped)
+
+        # Announced through the order_paid signal once the transaction commits.
+        db.session.info.setdefault('paid_orders', []).extend(changed)
+
+        return changed
+
+    @classmethod
+    def _flip_paid(cls, order_ids):
+
+        # The paid guard is on the UPDATE itself so that concurrent callers can't both
+        # claim the same order. Checking first and updating after is a race, and
+        # SELECT ... FOR UPDATE does nothing on SQLite.
+        table = cls.__table__
+        guarded = table.update().where(table.c.id.in_(order_ids)).where(table.c.paid.isnot(True)).values(paid=True)
+        dialect = db.session.get_bind(cls.__mapper__).dialect
+
+        if dialect.implicit_returning:
+            return [order_id for (order_id,) in db.session.execute(guarded.returning(table.c.id))]
+
+        # SQLite lets one writer in at a time. Once this transaction holds the write lock
+        # nobody else can pay these orders, so the unpaid ones read now are exactly the
+        # ones the UPDATE flips.
+        if dialect.name == 'sqlite':
+
+            connection = db.session.connection(mapper=cls.__mapper__)
+
+            # The driver only opens a transaction on the first write, one that's open
+            # already holds the lock.
+            if not connection.connection.in_transaction:
+                connection.execute('BEGIN IMMEDIATE')
+
+            unpaid = [order_id for (order_id,) in connection.execute(
+                select([table.c.id]).where(table.c.id.in_(order_ids)).where(table.c.paid.isnot(True))
+            )]
+
+            if unpaid:
+                connection.execute(guarded)
+
+            return unpaid
+
+        # Otherwise a statement per order tells which rows it flipped.
+        flip = table.update().where(table.c.id == bindparam('order_id')).where(table.c.paid.isnot(True))
+
+        return [
+            order_id for order_id in order_ids
+            if db.session.execute(flip.values(paid=True), {'order_id': order_id}).rowcount
+        ]
+
+    @classmethod
+    def mark_paid(cls, charge_ids, chunk_size=500):
+
+        """
+        Marks every unpaid order belonging to the given charges as paid. Returns the
+        ids of the orders that changed, the caller commits.
+        """
+
+        charge_ids = list(charge_ids)
+        order_ids = []
+
+        for start in range(0, len(charge_ids), chunk_size):
+            order_ids.extend(order_id for (order_id,) in db.session.query(cls.id).filter(
+                cls.charge_id.in_(charge_ids[start:start + chunk_size]),
+                cls.paid.isnot(True)
+            ))
+
+        return cls.apply_paid(order_ids, chunk_size)
+
     def check_paid(self):
+        return self._apply_own_status(self.fetch_paid(self.charge_id))
 
-        paid = strike.get_charge(self.charge_id)['paid']
+    async def check_paid_async(self):
 
-        if paid:
-            self.paid = True
-            db.session.commit()
+        """
+        Same as check_paid for servers running an event loop, the Strike lookup doesn't
+        block the loop. The caller commits.
+        """
+
+        return self._apply_own_status(await async_strike.call(self.fetch_paid, self.charge_id))
+
+    def _apply_own_status(self, paid):
+
+        if paid and not self.paid:
+            self.apply_paid([self.id])
+            set_committed_value(self, 'paid', True)
 
         return paid
 
 
+class OrderLine(db.Model):
+
+    """
+    A product on an order along with how many were ordered and the unit price charged.
+    """
+
+    __table__ = order_products
+
+    product = db.relationship('Product', lazy='joined')
+
+    def __str__(self):
+        name = self.product.name if self.product else 'Product #{}'.format(self.product_id)
+        return name if self.quantity == 1 else '{} x{}'.format(name, self.quantity)
+
+
+class ProductSales(db.Model):
+
+    """
+    Units sold and revenue in satoshi per product per day, kept up to date as orders
+    are paid so reports never have to go through every order. Revenue is the product's
+    price when the order was paid.
+    """
+
+    __tablename__ = 'product_sales'
+
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, index=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def record(cls, order_ids, day=None):
+
+        """
+        Adds the lines of newly paid orders to the day's totals, in the same transaction
+        that marks them as paid. Revenue is each line's quantity times the unit price it
+        was charged at.
+        """
+
+        day = day or datetime.utcnow().date()
+
+        # Lines added by hand in the admin have no charged price, the product's is used.
+        unit_price = func.coalesce(order_products.c.unit_price, Product.price, 0)
+
+        sales = db.session.query(
+            order_products.c.product_id,
+            func.sum(order_products.c.quantity),
+            func.sum(order_products.c.quantity * unit_price)
+        ).outerjoin(Product, Product.id == order_products.c.product_id).filter(
+            order_products.c.order_id.in_(order_ids)
+        ).group_by(order_products.c.product_id).all()
+
+        if sales:
+            db.session.execute(cls._upsert, [
+                {'day': day, 'product_id': product_id, 'units': units, 'revenue': revenue}
+                for product_id, units, revenue in sales
+            ])
+
+    # Adds to the row in one statement, so concurrent payments can't both insert it.
+    # Both PostgreSQL and SQLite (3.24 and later) understand ON CONFLICT.
+    _upsert = text(
+        'INSERT INTO product_sales (day, product_id, units, revenue) '
+        'VALUES (:day, :product_id, :units, :revenue) '
+        'ON CONFLICT (day, product_id) DO UPDATE SET '
+        'units = product_sales.units + excluded.units, '
+        'revenue = product_sales.revenue + excluded.revenue'
+    ).bindparams(bindparam('day', type_=db.Date))
+
+    @classmethod
+    def daily_totals(cls, days=30):
+
+        """
+        Returns (day, product id, product name, units, revenue) rows for the last few days, newest first.
+        """
+
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+
+        return db.session.query(
+            cls.day,
+            cls.product_id,
+            Product.name,
+            cls.units,
+            cls.revenue
+        ).outerjoin(Product, Product.id == cls.product_id).filter(
+            cls.day >= since
+        ).order_by(cls.day.desc(), cls.revenue.desc()).all()
+
+    @classmethod
+    def product_totals(cls, days=30):
+
+        """
+        Returns (product id, product name, units, revenue) rows summed over the last few days, best sellers first.
+        """
+
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+
+        return db.session.query(
+            cls.product_id,
+            Product.name,
+            func.sum(cls.units),
+            func.sum(cls.revenue)
+        ).outerjoin(Product, Product.id == cls.product_id).filter(
+            cls.day >= since
+        ).group_by(cls.product_id, Product.name).order_by(func.sum(cls.revenue).desc()).all()
+
+
+class WebhookEvent(db.Model):
+
+    """
+    A payment webhook delivery waiting to be verified against Strike. Deliveries are
+    deduplicated by charge and event, so retries and duplicates are only handled once.
+    """
+
+    __table_args__ = (
+        db.UniqueConstraint('charge_id', 'event', name='uq_webhook_event_charge_id_event'),
+        db.Index('ix_webhook_event_processed_at_id', 'processed_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    charge_id = db.Column(db.String(64), nullable=False)
+    event = db.Column(db.String(64), nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_attempt_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return 'Webhook {} for {}'.format(self.event, self.charge_id)
+
+    @classmethod
+    def enqueue(cls, charge_id, event):
+
+        """
+        Queues a delivery unless the same one is already queued. A repeat of a delivery
+        that was processed without its order being paid gets one more check, its attempts
+        aren't reset so it can't be retried forever. Returns True if anything was queued.
+        """
+
+        queued = cls.query.filter_by(charge_id=charge_id, event=event).first()
+
+        if queued is not None and queued.processed_at is None:
+            return False
+
+        try:
+            if queued is None:
+                db.session.add(cls(charge_id=charge_id, event=event))
+            else:
+                queued.processed_at = None
+                queued.next_attempt_at = None
+            db.session.commit()
+        except IntegrityError:
+            # Another worker queued the same delivery in the meantime.
+            db.session.rollback()
+            return False
+
+        return True
+
+    @classmethod
+    def pending(cls, limit):
+        return cls.query.filter(
+            cls.processed_at.is_(None),
+            db.or_(cls.next_attempt_at.is_(None), cls.next_attempt_at <= datetime.utcnow())
+        ).order_by(cls.id).limit(limit).all()
+
+    def retry_later(self, backoff, max_attempts):
+
+        """
+        Puts off a delivery that couldn't be verified yet, doubling the wait each time.
+        Returns False once it's been tried max_attempts times and is given up on.
+        """
+
+        self.attempts += 1
+
+        if self.attempts >= max_attempts:
+            self.processed_at = datetime.utcnow()
+            return False
+
+        self.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff * 2 ** (self.attempts - 1))
+        return True
+
+
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True, unique=True)
     name = db.Column(db.String(32), nullable=False)
@@ -137,17 +570,126 @@ class Product(db.Model):
     def __repr__(self):
         return self.name
 
+    @classmethod
+    def active_catalog(cls):
+
+        """
+        Returns every active product. The list is cached in-process and thrown away
+        whenever a product is created, edited or deleted.
+        """
+
+        return catalog_cache.get_or_load('active', cls._load_active_catalog)
+
+    @classmethod
+    def _load_active_catalog(cls):
+
+        products = cls.query.filter(cls.active.is_(True)).order_by(cls.id).all()
+
+        # Detached so the cached products outlive the session that loaded them.
+        for product in products:
+            db.session.expunge(product)
+
+        return products
+
     @property
     def filepath(self):
         if self.image is None:
             return
         return url_for('static', filename='images/' + self.image)
 
+    def srcset(self, extension=None):
+
+        """
+        Returns a srcset of the resized copies of this product's image that have been
+        rendered so far, in the original format or the given one such as 'webp'.
+        """
+
+        if self.image is None:
+            return ''
+
+        candidates = []
+
+        for width in IMAGE_WIDTHS:
+            filename = variant_filename(self.image, width, extension)
+            if os.path.exists(os.path.join(imagedir, filename)):
+                candidates.append('{} {}w'.format(url_for('static', filename='images/' + filename), width))
+
+        return ', '.join(candidates)
+
+
+@event.listens_for(Order, 'after_insert')
+def link_order_products(_mapper, connection, target):
+
+    lines = getattr(target, 'pending_lines', None)
+
+    if lines:
+        connection.execute(order_products.insert(), [
+            {'order_id': target.id, 'product_id': product_id, 'quantity': quantity, 'unit_price': unit_price}
+            for product_id, quantity, unit_price in lines
+        ])
+        del target.pending_lines
+
 
 @event.listens_for(Product, 'after_delete')
 def del_image(_mapper, _connection, target):
     if target.image is not None:
         try:
-            os.remove(target.image)
+            os.remove(os.path.join(imagedir, target.image))
         except OSError:
             pass
+        remove_variants(imagedir, target.image, IMAGE_WIDTHS)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_catalog_changes(session, _flush_context):
+
+    products = [obj for obj in chain(session.new, session.dirty, session.deleted) if isinstance(obj, Product)]
+
+    if products:
+        session.info['catalog_changed'] = True
+
+    # New uploads get their responsive copies rendered once the commit goes through,
+    # and the copies of the images they replaced are removed then too.
+    for product in products:
+
+        if product in session.deleted:
+            continue
+
+        history = inspect(product).attrs.image.history
+
+        if product.image and history.added:
+            session.info.setdefault('new_images', []).append(product.image)
+
+        for filename in history.deleted or ():
+            if filename:
+                session.info.setdefault('replaced_images', []).append(filename)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_catalog(session):
+
+    if session.info.pop('catalog_changed', False):
+        catalog_cache.clear()
+
+    filenames = session.info.pop('new_images', None)
+    if filenames:
+        product_images_changed.send(filenames=filenames)
+
+    # The admin removes a replaced original and its thumbnail itself, not the other sizes.
+    for filename in session.info.pop('replaced_images', []):
+        remove_variants(imagedir, filename, IMAGE_WIDTHS)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_pending_changes(session):
+    session.info.pop('catalog_changed', None)
+    session.info.pop('new_images', None)
+    session.info.pop('replaced_images', None)
+    session.info.pop('paid_orders', None)
+
+
+@event.listens_for(Session, 'after_commit')
+def announce_paid_orders(session):
+    order_ids = session.info.pop('paid_orders', None)
+    if order_ids:
+        order_paid.send(order_ids=order_ids)
@@ -0,0 +1,47 @@
+from contextlib import contextmanager
+from threading import Event, Lock
+
+
+class PaymentNotifier(object):
+
+    """
+    Lets requests wait for an order to be paid without anyone polling Strike. It's
+    told about payments through the order_paid signal, which the webhook worker, the
+    reconciler and manual checks all end up sending.
+
+    Only payments seen by this process wake its waiters, anything else is picked up
+    by the waiter checking the database again once it times out.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._listeners = {}
+
+    @contextmanager
+    def listen(self, order_id):
+
+        """
+        Yields an event that is set once the order is paid. Start listening before
+        checking the order so a payment landing in between isn't missed.
+        """
+
+        with self._lock:
+            listener = self._listeners.setdefault(order_id, [Event(), 0])
+            listener[1] += 1
+
+        try:
+            yield listener[0]
+        finally:
+            with self._lock:
+                listener[1] -= 1
+                if listener[1] == 0 and self._listeners.get(order_id) is listener:
+                    del self._listeners[order_id]
+
+    def notify(self, _sender=None, order_ids=()):
+
+        with self._lock:
+            listeners = [self._listeners.pop(order_id, None) for order_id in order_ids]
+
+        for listener in listeners:
+            if listener is not None:
+                listener[0].set()
@@ -0,0 +1,61 @@
+from collections import namedtuple
+
+from sqlalchemy import case, func
+
+from KaminariMerch.models import Product, db
+
+# A product as it was priced, only the columns checkout needs.
+PricedItem = namedtuple('PricedItem', ['id', 'name', 'price', 'quantity'])
+
+
+class CartQuote(object):
+
+    """
+    A price snapshot of a cart. Holds each product's name and unit price at the time
+    it was priced along with the total, so checkout can build the order from it
+    without going back to the database.
+    """
+
+    def __init__(self, items, total):
+        self.items = items
+        self.total = total
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    @property
+    def product_ids(self):
+        return [item.id for item in self.items]
+
+
+def price_cart(cart):
+
+    """
+    Prices a cart with a single query that only fetches the columns needed and sums
+    the total, quantities included, in SQL.
+    """
+
+    if not cart:
+        return CartQuote([], 0)
+
+    price = func.coalesce(Product.price, 0)
+    quantity = case(cart.items, value=Product.id, else_=0)
+
+    rows = db.session.query(
+        Product.id,
+        Product.name,
+        price.label('price'),
+        quantity.label('quantity'),
+        func.sum(price * quantity).over().label('total')
+    ).filter(Product.id.in_(cart.product_ids)).order_by(Product.id).all()
+
+    items = [PricedItem(row.id, row.name, row.price, row.quantity) for row in rows]
+    total = rows[0].total if rows else 0
+
+    return CartQuote(items, total)
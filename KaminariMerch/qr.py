@@ -0,0 +1,66 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_qrcode import QRcode
+from werkzeug.utils import secure_filename
+
+
+class QRCodeStore(object):
+
+    """
+    Renders payment request QR codes once per charge and keeps them on disk as PNGs,
+    so order pages can link to an image instead of encoding one on every render.
+    Codes are normally rendered in the background right after checkout.
+    """
+
+    def __init__(self, app, directory, workers=2):
+
+        self.app = app
+        self.directory = directory
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, charge_id):
+        return secure_filename('{}.png'.format(charge_id))
+
+    def path(self, charge_id):
+        return os.path.join(self.directory, self.filename(charge_id))
+
+    def exists(self, charge_id):
+        return os.path.exists(self.path(charge_id))
+
+    def generate(self, charge_id, payment_request):
+
+        """
+        Renders the QR code for a charge unless it's already on disk. Returns its path.
+        """
+
+        target = self.path(charge_id)
+
+        if os.path.exists(target):
+            return target
+
+        # The icon is looked up in the app's static folder, which needs an app context.
+        with self.app.app_context():
+            image = QRcode.qrcode(payment_request, mode='raw', error_correction='H', icon_img='qr-image.png')
+
+        # Written to the side and moved into place so nobody is served half a file. The
+        # temporary file is unique, a request can render the same code as the background
+        # worker at the same time.
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(image.getvalue())
+            os.replace(temporary, target)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+        return target
+
+    def schedule(self, charge_id, payment_request):
+        return self._executor.submit(self.generate, charge_id, payment_request)
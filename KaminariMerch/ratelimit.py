@@ -0,0 +1,170 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import request, Response
+from flask_security import current_user
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryRateLimitBackend(object):
+
+    """
+    Keeps token buckets in this process's memory. Every worker process gets its own
+    buckets, so a client spread across workers gets that many times the budget.
+    Buckets that have refilled are all alike, so the least recently used are dropped
+    once there are more than max_size of them.
+    """
+
+    def __init__(self, max_size=65536):
+
+        self.max_size = max_size
+
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key, rate, burst, now=None):
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+class RedisRateLimitBackend(object):
+
+    """
+    Keeps token buckets in Redis so every process and server shares the same budget.
+    Each bucket is updated by a single script call, so concurrent requests can't both
+    spend the last token. Needs the redis package.
+    """
+
+    # Returns 1 and 0 when allowed, or 0 and the seconds until a token is available.
+    SCRIPT = """
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+
+        if allowed == 1 then
+            return {1, '0'}
+        end
+
+        return {0, tostring((1 - tokens) / rate)}
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+
+        import redis
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst, now=None):
+
+        now = time.time() if now is None else now
+        allowed, retry_after = self._script(keys=[self.prefix + key], args=[rate, burst, now])
+
+        return bool(allowed), float(retry_after)
+
+
+class RateLimiter(object):
+
+    """
+    Token bucket rate limiting for individual views. Each named budget is a
+    (requests per minute, burst) pair, a client can make burst requests straight
+    away and then gets requests back at the steady rate. Signed in users are
+    limited by their account, everyone else by their IP address.
+    """
+
+    def __init__(self, backend, budgets, enabled=True):
+
+        self.backend = backend
+        self.budgets = budgets
+        self.enabled = enabled
+
+    def _client_key(self):
+
+        if current_user.is_authenticated:
+            return 'user:{}'.format(current_user.id)
+
+        return 'ip:{}'.format(request.remote_addr)
+
+    def limit(self, name):
+
+        """
+        Decorates a view so it's only run while the client has budget left, otherwise
+        responds with 429 Too Many Requests and a Retry-After header.
+        """
+
+        def decorator(view):
+
+            @wraps(view)
+            def limited(*args, **kwargs):
+
+                budget = self.budgets.get(name)
+
+                if self.enabled and budget:
+
+                    per_minute, burst = budget
+                    key = '{}:{}'.format(name, self._client_key())
+                    allowed, retry_after = self.backend.take(key, per_minute / 60.0, burst)
+
+                    if not allowed:
+                        return Response(
+                            'Too many requests, please try again shortly.',
+                            429,
+                            {'Retry-After': str(max(1, int(retry_after + 0.999)))}
+                        )
+
+                return view(*args, **kwargs)
+
+            return limited
+
+        return decorator
+
+
+def create_rate_limiter(config):
+
+    """
+    Creates the rate limiter with the backend selected by the RATELIMIT_STORAGE setting.
+    """
+
+    if config['RATELIMIT_STORAGE'] == 'memory':
+        backend = MemoryRateLimitBackend()
+    elif config['RATELIMIT_STORAGE'] == 'redis':
+        backend = RedisRateLimitBackend(config['RATELIMIT_STORAGE_URL'])
+    else:
+        raise ValueError('Unknown rate limit storage: {}'.format(config['RATELIMIT_STORAGE']))
+
+    return RateLimiter(backend, config['RATELIMIT_BUDGETS'], enabled=config['RATELIMIT_ENABLED'])
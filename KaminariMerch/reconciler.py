@@ -0,0 +1,131 @@
+import time
+from threading import Thread, Event
+
+from KaminariMerch.models import Order, db
+
+
+def _seconds(timestamp):
+
+    """
+    Strike timestamps are sometimes given in milliseconds, this normalises them to seconds.
+    """
+
+    return timestamp / 1000.0 if timestamp > 1e11 else float(timestamp)
+
+
+class PaymentReconciler(object):
+
+    """
+    Background worker that keeps order payment status in sync with Strike without
+    relying on webhooks or users checking their orders.
+
+    Each pass pages through Strike's charge list (newest first) and marks every
+    unpaid order with a paid charge as paid in a single transaction. A high-water
+    mark remembers where the oldest still payable invoice was, so later passes only
+    cover charges from that point on instead of the entire history.
+    """
+
+    def __init__(self, app, client, interval=30, page_size=100, max_pages=50, invoice_expiry=3600):
+
+        self.app = app
+        self.client = client
+        self.interval = interval
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.invoice_expiry = invoice_expiry
+        self.high_water_mark = 0
+        self.resume = None
+
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+
+        self._thread = Thread(target=self._run, name='payment-reconciler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.reconcile()
+                except Exception:
+                    self.app.logger.exception('Payment reconciliation pass failed.')
+                finally:
+                    db.session.remove()
+
+    def scan(self):
+
+        """
+        Pages through charges created since the high-water mark. Returns the ids of
+        every paid charge seen, the new high-water mark and where to resume from.
+
+        The mark only moves once a scan has gone all the way back to it. A scan that
+        stops early, at max_pages or on a failed request, keeps the mark where it is and
+        returns the page to carry on from next pass, so no charge in between is skipped.
+        """
+
+        horizon = time.time() - self.invoice_expiry
+        paid = []
+        first_page, newest, oldest_open = self.resume or (0, None, None)
+
+        for page in range(first_page, first_page + self.max_pages):
+
+            charges = self.client.list_charges(page, self.page_size)
+
+            # Strike couldn't be reached, try this page again next pass.
+            if charges is None:
+                return paid, self.high_water_mark, (page, newest, oldest_open)
+
+            for charge in charges:
+
+                created = _seconds(charge['created'])
+
+                if created < self.high_water_mark:
+                    return paid, self._next_mark(newest, oldest_open), None
+
+                newest = created if newest is None else max(newest, created)
+
+                # Unpaid invoices hold the mark back until they either get paid or expire.
+                if charge['paid']:
+                    paid.append(charge['id'])
+                elif created >= horizon:
+                    oldest_open = created if oldest_open is None else min(oldest_open, created)
+
+            if len(charges) < self.page_size:
+                return paid, self._next_mark(newest, oldest_open), None
+
+        # New charges only push older ones onto later pages, so resuming from the next
+        # page may see some charges twice but never misses one.
+        return paid, self.high_water_mark, (page + 1, newest, oldest_open)
+
+    def _next_mark(self, newest, oldest_open):
+
+        if oldest_open is not None:
+            return oldest_open
+
+        if newest is not None:
+            return newest
+
+        return self.high_water_mark
+
+    def reconcile(self):
+
+        """
+        Runs a single reconciliation pass and returns the number of orders marked as paid.
+        """
+
+        paid, mark, resume = self.scan()
+
+        updated = Order.mark_paid(paid)
+        db.session.commit()
+
+        self.high_water_mark = mark
+        self.resume = resume
+
+        return len(updated)
@@ -0,0 +1,11 @@
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+# Sent once a commit that marked orders as paid has gone through, with the ids
+# of those orders as order_ids.
+order_paid = _signals.signal('order-paid')
+
+# Sent once a commit that added or replaced product images has gone through,
+# with the new image filenames as filenames.
+product_images_changed = _signals.signal('product-images-changed')
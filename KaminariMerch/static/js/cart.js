@@ -1,18 +1,42 @@
 $(document).ready(function() {
 
-    function remove_from_cart(id) {
+    // Sends a batch of cart changes in a single request and updates the page in place.
+    function update_cart(operations) {
+
+        return $.ajax({
+            url: '/update_cart',
+            type: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({operations: operations})
+        }).done(function (data) {
+
+            var remaining = {};
+
+            $.each(data.cart, function (_, item) {
+                remaining[item.id] = true;
+                $('#cart-item-' + item.id + ' .cart-quantity').text(item.quantity);
+            });
+
+            $('.remove-button').each(function () {
+                if (!remaining[$(this).val()]) {
+                    $('#cart-item-' + $(this).val()).remove();
+                }
+            });
+
+            $('#cart-total').text(data.total);
+
+            // Shows the empty cart page once the last item is gone.
+            if (data.cart.length === 0) {
+                location.reload();
+            }
 
-        $.post('/remove_from_cart', {
-            id: id
-        }).done(function () {
-            location.reload();
         })
 
     }
 
     $('.remove-button').click(function () {
         $this = $(this);
-        remove_from_cart($this.val())
+        update_cart([{op: 'remove', id: $this.val()}]);
     });
 
-});
\ No newline at end of file
+});
@@ -1,6 +1,7 @@
 $(document).ready(function() {
 
-    var socket = io.connect('http://' + document.domain + ':' + location.port);
+    var order_id = $('#order').data('order-id');
+    var polling = false;
 
     function mark_order_as_paid() {
         $('#tick').show();
@@ -10,30 +11,56 @@ $(document).ready(function() {
         $('.btn').hide();
     }
 
-    socket.on('connect', function() {
-        socket.emit('subscribe', {order: $('#check-button').val() });
-    });
+    // Long-polls the order status, the server holds each request open until the
+    // order is paid or it times out. Used whenever the websocket isn't available.
+    function wait_for_payment() {
 
-    socket.on('confirm_payment', function() {
-       mark_order_as_paid();
-    });
+        $.getJSON('/order/' + order_id + '/status', {
+            wait: 25
+        }).done(function(data) {
 
+            if (data.paid === true) {
+                mark_order_as_paid();
+            } else {
+                wait_for_payment();
+            }
 
-    $('#check-button').click(function() {
+        }).fail(function() {
+            setTimeout(wait_for_payment, 5000);
+        });
+    }
 
-        $this = $(this);
+    function start_polling() {
+        if (!polling) {
+            polling = true;
+            wait_for_payment();
+        }
+    }
 
-        $.post('/check_payment', {
-            id: $this.val()
-        }).done(function(data) {
+    var socket = io.connect('http://' + document.domain + ':' + location.port);
 
-            if (data.paid === true) {
-                mark_order_as_paid()
+    socket.on('connect', function() {
+        socket.emit('subscribe', {order: order_id}, function(subscribed) {
+            if (!subscribed) {
+                start_polling();
             }
-
         });
     });
 
+    socket.on('confirm_payment', function() {
+       mark_order_as_paid();
+    });
+
+    socket.on('connect_error', start_polling);
+    socket.on('disconnect', start_polling);
+
+    // Servers without websockets never connect, fall back to polling after a moment.
+    setTimeout(function() {
+        if (!socket.connected) {
+            start_polling();
+        }
+    }, 5000);
+
     // https://codepen.io/shaikmaqsood/pen/XmydxJ
     function copyToClipboard(element) {
         var $temp = $("<input>");
@@ -47,4 +74,4 @@ $(document).ready(function() {
         copyToClipboard('#payment-request')
     });
 
-});
\ No newline at end of file
+});
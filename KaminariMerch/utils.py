@@ -1,10 +1,14 @@
+import asyncio
 from os import path
+from threading import local
 from uuid import uuid1
 
-from flask import session
+from flask_security.utils import hash_password
 from werkzeug.utils import secure_filename
 from KaminariMerch import Product, db
 
+_event_loops = local()
+
 
 def secure_uuid_filename(_obj, data):
 
@@ -17,6 +21,22 @@ def secure_uuid_filename(_obj, data):
     return secure_filename('{}{}'.format(uid, ext))
 
 
+def run_async(coroutine):
+
+    """
+    Runs a coroutine to completion from synchronous code such as a Flask view.
+    Every thread keeps its own event loop so any database work the coroutine does
+    stays on that thread's session.
+    """
+
+    loop = getattr(_event_loops, 'loop', None)
+
+    if loop is None:
+        loop = _event_loops.loop = asyncio.new_event_loop()
+
+    return loop.run_until_complete(coroutine)
+
+
 def generate_example_products():
 
     example_products = [
@@ -37,27 +57,42 @@ def generate_example_products():
     db.session.commit()
 
 
-def in_cart(product):
-    return any(str(product) in d for d in session['cart'])
+def create_admin(user_datastore, email, password):
 
+    """
+    Creates an administrator account with the given credentials, or gives an existing
+    account with that email the admin role. Existing passwords are left alone.
+    """
 
-def add_product_to_cart(product):
+    user_datastore.find_or_create_role(name='admin', description='Administrator')
 
+    if not user_datastore.get_user(email):
+        user_datastore.create_user(email=email, password=hash_password(password))
 
-    """
-    Adds a product to the users carts.
-    """
+    db.session.commit()
+
+    user_datastore.add_role_to_user(email, 'admin')
+    db.session.commit()
 
-    cart = session['cart']
-    cart.append(str(product.id))
-    session['cart'] = cart
 
-def remove_product_from_cart(product):
+def seed_example_users(user_datastore):
 
     """
-    Removes a product from the users cart.
+    Creates the admin role and two example accounts for evaluating the store,
+    unless they already exist.
     """
 
-    cart = session['cart']
-    cart.remove(str(product.id))
-    session['cart'] = cart
+    # Create the Role "admin" -- unless it already exists
+    user_datastore.find_or_create_role(name='admin', description='Administrator')
+
+    # Create two Users for testing purposes -- unless they already exists.
+    # In each case, use Flask-Security utility function to encrypt the password.
+    for email in ('someone@example.com', 'admin@example.com'):
+        if not user_datastore.get_user(email):
+            user_datastore.create_user(email=email, password=hash_password('password'))
+
+    # Commit any database changes; the User and Roles must exist before we can add a Role to the User
+    db.session.commit()
+
+    user_datastore.add_role_to_user('admin@example.com', 'admin')
+    db.session.commit()
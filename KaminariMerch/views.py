@@ -1,16 +1,21 @@
-from os import path
-from flask import url_for, redirect, request, abort
+import csv
+import gzip
+import io
+import json
+
+from flask import url_for, redirect, request, abort, flash, g, Response, stream_with_context
 from flask_security import current_user
+from flask_admin.babel import gettext
 from flask_admin.contrib.sqla import ModelView
-from flask_admin import AdminIndexView, form
+from flask_admin.helpers import get_redirect_target
+from flask_admin import AdminIndexView, BaseView, expose, form
+from werkzeug.utils import secure_filename
 
 from KaminariMerch.formatters import payment_status_formatter, product_image_formatter
+from KaminariMerch.images import imagedir
+from KaminariMerch.models import ProductSales, eager_options
 from KaminariMerch.utils import secure_uuid_filename
 
-from config import basedir
-
-imagedir = path.join(basedir, 'KaminariMerch/static/images')
-
 
 class IndexView(AdminIndexView):
 
@@ -26,10 +31,165 @@ class IndexView(AdminIndexView):
                 return redirect(url_for('security.login', next=request.url))
 
 
-class OrderView(ModelView):
+class EagerLoadingMixin(object):
+
+    """
+    Loads the relationships shown in a list view along with the rows rather than with
+    one extra query per row. column_eager_loading maps relationship names to a loading
+    strategy ('joined', 'selectin' or 'subquery') and defaults to the model's list_loading.
+    """
+
+    column_eager_loading = None
+
+    def get_query(self):
+
+        query = super(EagerLoadingMixin, self).get_query()
+
+        # Exports only select ids from the list query and load the rows themselves later.
+        if g.get('exporting_ids'):
+            return query
+
+        return query.options(*eager_options(self.model, self.column_eager_loading))
+
+
+def _gzip_stream(chunks):
+
+    """
+    Compresses a stream of text chunks as it goes, yielding gzip data.
+    """
+
+    buffer = io.BytesIO()
+    compressor = gzip.GzipFile(fileobj=buffer, mode='wb')
+
+    for chunk in chunks:
+        compressor.write(chunk.encode('utf-8'))
+        data = buffer.getvalue()
+        if data:
+            yield data
+            buffer.seek(0)
+            buffer.truncate()
+
+    compressor.close()
+    yield buffer.getvalue()
+
+
+class StreamingExportMixin(object):
+
+    """
+    Replaces the admin's export, which builds the whole export in memory, with one that
+    streams. Matching ids are read through a server-side cursor and rows are loaded
+    export_chunk_size at a time, relationships included, then written out straight away
+    as CSV or JSON Lines, optionally gzipped. Search and filters still apply.
+    """
+
+    export_types = ['csv', 'csv.gz', 'jsonl', 'jsonl.gz']
+    export_chunk_size = 1000
+
+    @expose('/export/<export_type>/')
+    def export(self, export_type):
+
+        return_url = get_redirect_target() or self.get_url('.index_view')
+
+        if not self.can_export or export_type not in self.export_types:
+            flash(gettext('Permission denied.'), 'error')
+            return redirect(return_url)
+
+        export_format, _, compression = export_type.partition('.')
+        view_args = self._get_list_extra_args()
+
+        g.exporting_ids = True
+        try:
+            _, query = self.get_list(None, None, False, view_args.search, view_args.filters, execute=False, page_size=0)
+        finally:
+            g.exporting_ids = False
+
+        if export_format == 'csv':
+            chunks = self._export_csv_chunks(query)
+            mimetype = 'text/csv'
+        else:
+            chunks = self._export_jsonl_chunks(query)
+            mimetype = 'application/x-ndjson'
+
+        if compression == 'gz':
+            chunks = _gzip_stream(chunks)
+            mimetype = 'application/gzip'
+
+        filename = secure_filename(self.get_export_name(export_type))
+
+        return Response(
+            stream_with_context(chunks),
+            headers={'Content-Disposition': 'attachment;filename={}'.format(filename)},
+            mimetype=mimetype
+        )
+
+    def _export_chunks(self, query):
+
+        """
+        Yields lists of models matching the list query, a chunk at a time.
+        """
+
+        primary_key = getattr(self.model, self._primary_key)
+        ids = query.with_entities(primary_key).order_by(None).order_by(primary_key)
+        ids = ids.execution_options(stream_results=True).yield_per(self.export_chunk_size)
+
+        loader = self.session.query(self.model).options(
+            *eager_options(self.model, getattr(self, 'column_eager_loading', None))
+        )
+
+        chunk = []
+
+        for (model_id,) in ids:
+            chunk.append(model_id)
+            if len(chunk) == self.export_chunk_size:
+                yield loader.filter(primary_key.in_(chunk)).order_by(primary_key).all()
+                chunk = []
 
-    column_list = ('id', 'user', 'products', 'total_cost', 'paid')
-    column_editable_list = ('user', 'products')
+        if chunk:
+            yield loader.filter(primary_key.in_(chunk)).order_by(primary_key).all()
+
+    def _export_csv_chunks(self, query):
+
+        output = io.StringIO()
+        writer = csv.writer(output)
+
+        writer.writerow([label for _, label in self._export_columns])
+
+        for models in self._export_chunks(query):
+
+            for model in models:
+                writer.writerow([self.get_export_value(model, name) for name, _ in self._export_columns])
+
+            # Hands each chunk over straight away so memory stays flat.
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+
+        yield output.getvalue()
+
+    def _export_jsonl_chunks(self, query):
+
+        for models in self._export_chunks(query):
+
+            yield ''.join(
+                json.dumps({name: self.get_export_value(model, name) for name, _ in self._export_columns}, default=str) + '\n'
+                for model in models
+            )
+
+
+class OrderView(StreamingExportMixin, EagerLoadingMixin, ModelView):
+
+    column_list = ('id', 'user', 'lines', 'total_cost', 'paid')
+
+    # Order lines are written at checkout, products are still edited through the form.
+    form_excluded_columns = ('lines',)
+
+    # Users and products are searched for as you type instead of every one of them
+    # being loaded into the edit form. Editing them inline in the list is left out
+    # as that loaded the choices once for every row.
+    form_ajax_refs = {
+        'user': {'fields': ('email',)},
+        'products': {'fields': ('name',)},
+    }
 
     can_view_details = True
 
@@ -52,6 +212,7 @@ class OrderView(ModelView):
 
     column_labels = {
         'id': 'ID',
+        'lines': 'Products',
         'paid': 'Payment Status',
         'total_cost': 'Total Cost (Satoshi)'
     }
@@ -65,7 +226,7 @@ class OrderView(ModelView):
         self.name = 'Orders'
 
 
-class UserView(ModelView):
+class UserView(EagerLoadingMixin, ModelView):
 
     column_hide_backrefs = False
     column_list = ('email', 'roles', 'orders')
@@ -82,7 +243,7 @@ class UserView(ModelView):
                 return redirect(url_for('security.login', next=request.url))
 
 
-class ProductView(ModelView):
+class ProductView(StreamingExportMixin, ModelView):
 
     can_view_details = True
     column_list = ('image', 'name', 'description', 'price', 'active')
@@ -103,13 +264,50 @@ class ProductView(ModelView):
         'image': product_image_formatter
     }
 
+    # Thumbnails and other sizes are rendered by the image pipeline once the product is saved.
     form_extra_fields = {
         'image': form.ImageUploadField(
             'Image',
             base_path=imagedir,
             url_relative_path='images/',
-            thumbnail_size=(200, 200, True),
             namegen=secure_uuid_filename)
     }
 
     can_export = True
+
+
+class SalesView(BaseView):
+
+    """
+    Sales per product and per day, read from the running totals kept as orders are
+    paid rather than added up from every order on each visit.
+    """
+
+    def __init__(self, days=30, *args, **kwargs):
+        super(SalesView, self).__init__(*args, **kwargs)
+        self.days = days
+
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.has_role('admin')
+
+    def _handle_view(self, name, **kwargs):
+
+        if not self.is_accessible():
+            if current_user.is_authenticated:
+                abort(403)
+            else:
+                return redirect(url_for('security.login', next=request.url))
+
+    @expose('/')
+    def index(self):
+
+        products = ProductSales.product_totals(self.days)
+
+        return self.render(
+            'admin/sales.html',
+            days=self.days,
+            products=products,
+            daily=ProductSales.daily_totals(self.days),
+            total_units=sum(units for _, _, units, _ in products),
+            total_revenue=sum(revenue for _, _, _, revenue in products)
+        )
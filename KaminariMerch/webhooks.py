@@ -0,0 +1,107 @@
+from datetime import datetime
+from threading import Thread, Event
+
+from KaminariMerch.models import Order, WebhookEvent, charge_cache, db
+from KaminariMerch.utils import run_async
+
+
+class WebhookQueueWorker(object):
+
+    """
+    Background worker that drains queued payment webhooks. Each batch skips charges
+    whose orders are already paid, verifies the rest against Strike concurrently and
+    marks the paid orders in one transaction along with the processed deliveries.
+    Deliveries whose charge couldn't be looked up or isn't paid yet are retried with
+    a growing delay, retry_backoff seconds at first, up to max_attempts times.
+    """
+
+    def __init__(self, app, interval=5, batch_size=100, max_attempts=8, retry_backoff=10):
+
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+
+        self._wakeup = Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+
+        self._thread = Thread(target=self._run, name='webhook-worker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def wake(self):
+
+        """
+        Lets the worker know there's something new in the queue rather than waiting out the interval.
+        """
+
+        self._wakeup.set()
+
+    def _run(self):
+
+        while not self._stopped:
+
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+            with self.app.app_context():
+                try:
+                    while self.drain() == self.batch_size:
+                        pass
+                except Exception:
+                    self.app.logger.exception('Processing queued webhooks failed.')
+                finally:
+                    db.session.remove()
+
+    def drain(self):
+
+        """
+        Processes a single batch of queued deliveries and returns how many there were.
+        """
+
+        events = WebhookEvent.pending(self.batch_size)
+
+        if not events:
+            return 0
+
+        charge_ids = set(event.charge_id for event in events)
+
+        # No point asking Strike about orders we already know are paid.
+        unpaid = [charge_id for (charge_id,) in db.session.query(Order.charge_id).filter(
+            Order.charge_id.in_(charge_ids),
+            Order.paid.isnot(True)
+        )]
+
+        # A delivery means the charge changed, so cached statuses can't be trusted.
+        for charge_id in unpaid:
+            charge_cache.invalidate(charge_id)
+
+        charges = run_async(Order.fetch_charges(unpaid))
+        paid = [charge_id for charge_id, charge in charges.items() if charge and charge['paid']]
+        unverified = set(charges) - set(paid)
+
+        Order.mark_paid(paid)
+
+        processed = [event.id for event in events if event.charge_id not in unverified]
+
+        if processed:
+            WebhookEvent.query.filter(WebhookEvent.id.in_(processed)).update(
+                {'processed_at': datetime.utcnow()},
+                synchronize_session=False
+            )
+
+        for event in events:
+            if event.charge_id in unverified and not event.retry_later(self.retry_backoff, self.max_attempts):
+                self.app.logger.warning('Giving up on verifying {} after {} attempts.'.format(event, event.attempts))
+
+        db.session.commit()
+
+        return len(events)
@@ -7,6 +7,48 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 # Do NOT leak this!
 STRIKE_API_KEY = 'put-strike-api-key-here'
 
+# How the Strike API client talks to Strike. The pool size is the number of
+# keep-alive connections held open, timeouts are in seconds and only GET
+# requests are retried, backing off exponentially between attempts. The endpoint
+# can be pointed elsewhere, such as at a local stub, with STRIKE_ENDPOINT.
+STRIKE_ENDPOINT = os.environ.get('STRIKE_ENDPOINT', 'https://api.dev.strike.acinq.co/api/v1')
+STRIKE_POOL_SIZE = 10
+STRIKE_CONNECT_TIMEOUT = 3.05
+STRIKE_READ_TIMEOUT = 10
+STRIKE_MAX_RETRIES = 3
+STRIKE_RETRY_BACKOFF = 0.3
+
+# The most Strike requests the async client will have in flight at once. Checkouts
+# and payment checks awaited from an event loop share the first budget, background
+# batches such as verifying queued webhooks have their own. Regular requests talk to
+# Strike through the pooled client directly.
+STRIKE_MAX_IN_FLIGHT = 10
+STRIKE_BACKGROUND_MAX_IN_FLIGHT = 10
+
+# How long, in seconds, an unpaid charge status from Strike is reused before
+# asking again, and how many charges are remembered. Paid charges are kept
+# until they are pushed out by newer ones.
+CHARGE_CACHE_TTL = 5
+CHARGE_CACHE_SIZE = 4096
+
+# The active product catalog and the rendered product grid are cached in memory
+# and refreshed when a product changes. Other processes only see those changes
+# once this many seconds pass. The size bounds how many cart/login variations
+# of the product grid are kept.
+CATALOG_CACHE_TTL = 60
+CATALOG_CACHE_SIZE = 512
+
+# Invoices that have gone unpaid for this many seconds are considered expired.
+STRIKE_INVOICE_EXPIRY = 3600
+
+# Periodically pulls the charge list from Strike in the background and marks
+# any orders that were paid as such, in case a webhook never arrives. When
+# running several worker processes it's enough to enable this in one of them.
+RECONCILE_PAYMENTS = True
+RECONCILE_INTERVAL = 30
+RECONCILE_PAGE_SIZE = 100
+RECONCILE_MAX_PAGES = 50
+
 # Dictates if CSRF protection should be enabled.
 # If you don't know what that is, it's a safe bet that
 # you probably want to leave this set to True.
@@ -36,9 +78,122 @@ SECURITY_PASSWORD_HASH = 'bcrypt'
 SECURITY_REGISTERABLE = True
 SECURITY_SEND_REGISTER_EMAIL = False
 
+# Migrates the database and creates the example accounts (including an admin
+# with the password "password") when the app is created, handy for local
+# development only, so it's only turned on by the Development settings below.
+# Everywhere else run `flask bootstrap` once per deploy instead, passing
+# ADMIN_EMAIL and ADMIN_PASSWORD in the environment the first time to create a
+# real admin account.
+BOOTSTRAP_ON_STARTUP = False
+
 # Where to store the database file.
 SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/db.sqlite'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool settings for server databases such as PostgreSQL. Pre-ping
+# checks connections are still alive before use and recycle (in seconds)
+# replaces connections before the server drops them. These don't apply to
+# SQLite, which instead waits up to SQLITE_BUSY_TIMEOUT seconds for a lock and
+# can use write-ahead logging so readers never block the writer.
+DATABASE_POOL_SIZE = 10
+DATABASE_MAX_OVERFLOW = 20
+DATABASE_POOL_PRE_PING = True
+DATABASE_POOL_RECYCLE = 1800
+SQLITE_WAL = True
+SQLITE_BUSY_TIMEOUT = 15
+
+# Payment webhooks are queued and verified in batches of WEBHOOK_BATCH_SIZE.
+# The worker is woken by new deliveries and otherwise checks the queue every
+# WEBHOOK_WORKER_INTERVAL seconds. Deliveries that can't be verified yet are
+# retried after WEBHOOK_RETRY_BACKOFF seconds, doubling each time, and given up
+# on after WEBHOOK_MAX_ATTEMPTS tries.
+WEBHOOK_WORKER_INTERVAL = 5
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_BACKOFF = 10
+
+# Widths, in pixels, of the resized copies made of uploaded product images.
+# Each is made in the original format and as WebP by IMAGE_WORKERS processes.
+IMAGE_WIDTHS = (300, 600, 1200)
+IMAGE_QUALITY = 80
+IMAGE_WORKERS = 2
+
+# Where payment request QR codes are kept once rendered, and how many threads
+# render them in the background.
+QR_CODE_DIR = '/tmp/kaminari-qr'
+QR_CODE_WORKERS = 2
+
+# The longest, in seconds, an order page's status request may be held open
+# waiting for the payment to come through.
+ORDER_STATUS_MAX_WAIT = 25
+
+# Message queue shared by every process serving websockets, so a payment seen
+# by one process is pushed to clients connected to any of them. Leave as None
+# when running a single process. Use a Redis URL such as 'redis://localhost:6379/0'
+# (needs the redis package) in production, or 'memory://' (needs kombu) for an
+# in-process broker when testing.
+SOCKETIO_MESSAGE_QUEUE = None
+SOCKETIO_CHANNEL = 'kaminari'
+
+# How many items a page of the JSON API returns by default, and at most.
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# Token bucket rate limits per client, by user when signed in and by IP address
+# otherwise. Each budget is (requests per minute, burst). Routes that reach Strike
+# get the tightest budgets. Use 'memory' storage for a single process, or 'redis'
+# (needs the redis package) so every process shares the same budgets.
+RATELIMIT_ENABLED = True
+RATELIMIT_STORAGE = 'memory'
+RATELIMIT_STORAGE_URL = 'redis://localhost:6379/0'
+RATELIMIT_BUDGETS = {
+    'check_payment': (12, 5),
+    'checkout': (6, 3),
+    'add_to_cart': (60, 20),
+    'remove_from_cart': (60, 20),
+    'update_cart': (60, 20),
+}
+
+# How many days of sales the admin sales report covers.
+SALES_REPORT_DAYS = 30
+
+# Where shopping carts are kept on the server. Either 'sqlite' to keep them in
+# their own database file or 'memory' to keep them in the process, which loses
+# them on restart. Carts expire after going untouched for CART_TTL seconds and
+# expired carts are cleared out every CART_SWEEP_INTERVAL seconds.
+CART_STORE = 'sqlite'
+CART_STORE_PATH = '/tmp/carts.sqlite'
+CART_TTL = 60 * 60 * 24 * 7
+CART_SWEEP_INTERVAL = 600
+
 # Minimizes HTML when generating templates if set to True.
 MINIFY_PAGE = True
+
+
+# Per environment settings, selected with create_app(environment) or, when no
+# environment is passed, such as for `flask` commands and app.py, with the
+# KAMINARI_ENV environment variable (e.g. KAMINARI_ENV=development). Anything
+# set here overrides the defaults above.
+
+class Development(object):
+    DEBUG = True
+    BOOTSTRAP_ON_STARTUP = True
+
+
+class Production(object):
+    DEBUG = False
+    BOOTSTRAP_ON_STARTUP = False
+
+    # Needs a PostgreSQL driver such as psycopg2 installed.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://kaminari@localhost/kaminari')
+    DATABASE_POOL_SIZE = 20
+    DATABASE_MAX_OVERFLOW = 40
+
+
+class Testing(object):
+    TESTING = True
+    BOOTSTRAP_ON_STARTUP = False
+    RECONCILE_PAYMENTS = False
+    WTF_CSRF_ENABLED = False
+    CART_STORE = 'memory'
+    MINIFY_PAGE = False
@@ -0,0 +1,54 @@
+"""Indexes for order lookups and primary keys on association tables
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+
+    # Association rows without both ends can't be part of a primary key, and never meant anything anyway.
+    op.execute('DELETE FROM roles_users WHERE user_id IS NULL OR role_id IS NULL')
+    op.execute('DELETE FROM order_products WHERE order_id IS NULL OR product_id IS NULL')
+
+    with op.batch_alter_table('roles_users') as batch_op:
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('role_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_roles_users', ['user_id', 'role_id'])
+
+    with op.batch_alter_table('order_products') as batch_op:
+        batch_op.alter_column('order_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('product_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_order_products', ['order_id', 'product_id'])
+
+    op.create_index('ix_order_products_product_id', 'order_products', ['product_id'])
+    op.create_index('ix_order_user_id', 'order', ['user_id'])
+    op.create_index('ix_order_paid_id', 'order', ['paid', 'id'])
+
+
+def downgrade():
+
+    op.drop_index('ix_order_paid_id', table_name='order')
+    op.drop_index('ix_order_user_id', table_name='order')
+    op.drop_index('ix_order_products_product_id', table_name='order_products')
+
+    with op.batch_alter_table('order_products') as batch_op:
+        batch_op.drop_constraint('pk_order_products', type_='primary')
+        batch_op.alter_column('product_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('order_id', existing_type=sa.Integer(), nullable=True)
+
+    with op.batch_alter_table('roles_users') as batch_op:
+        batch_op.drop_constraint('pk_roles_users', type_='primary')
+        batch_op.alter_column('role_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=True)
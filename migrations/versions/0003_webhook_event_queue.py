@@ -0,0 +1,35 @@
+"""Queue table for incoming payment webhooks
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 14:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'webhook_event',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('charge_id', sa.String(length=64), nullable=False),
+        sa.Column('event', sa.String(length=64), nullable=False),
+        sa.Column('received_at', sa.DateTime(), nullable=True),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('charge_id', 'event', name='uq_webhook_event_charge_id_event')
+    )
+    op.create_index('ix_webhook_event_processed_at_id', 'webhook_event', ['processed_at', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_webhook_event_processed_at_id', table_name='webhook_event')
+    op.drop_table('webhook_event')
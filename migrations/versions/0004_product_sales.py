@@ -0,0 +1,33 @@
+"""Daily sales totals per product
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 16:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'product_sales',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('units', sa.Integer(), nullable=False),
+        sa.Column('revenue', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('day', 'product_id')
+    )
+    op.create_index(op.f('ix_product_sales_product_id'), 'product_sales', ['product_id'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_product_sales_product_id'), table_name='product_sales')
+    op.drop_table('product_sales')
@@ -0,0 +1,36 @@
+"""Quantity and unit price on order lines
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 10:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+
+    with op.batch_alter_table('order_products') as batch_op:
+        batch_op.add_column(sa.Column('quantity', sa.Integer(), nullable=False, server_default='1'))
+        batch_op.add_column(sa.Column('unit_price', sa.Integer(), nullable=True))
+
+    # What existing orders were charged per product wasn't kept, the current price is the best guess.
+    op.execute(
+        'UPDATE order_products SET unit_price = '
+        '(SELECT product.price FROM product WHERE product.id = order_products.product_id)'
+    )
+
+
+def downgrade():
+
+    with op.batch_alter_table('order_products') as batch_op:
+        batch_op.drop_column('unit_price')
+        batch_op.drop_column('quantity')
@@ -0,0 +1,83 @@
+import pytest
+from flask_security.utils import hash_password
+from sqlalchemy import event
+
+from KaminariMerch import create_app
+from KaminariMerch.models import Order, Product, db
+
+
+@pytest.fixture
+def app(tmp_path):
+
+    app = create_app('testing', {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.sqlite')})
+
+    with app.app_context():
+        db.create_all()
+
+        datastore = app.extensions['security'].datastore
+        admin = datastore.create_user(email='admin@example.com', password=hash_password('password'))
+        datastore.add_role_to_user(admin, datastore.find_or_create_role('admin'))
+        db.session.add_all([Product(name='Product {}'.format(number), price=100) for number in range(3)])
+        db.session.commit()
+
+    yield app
+
+    app.extensions['webhook_worker'].stop()
+    app.extensions['cart_store'].stop_sweeper()
+
+
+@pytest.fixture
+def client(app):
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'password'})
+
+    return client
+
+
+def add_orders(app, count):
+
+    with app.app_context():
+
+        admin = app.extensions['security'].datastore.find_user(email='admin@example.com')
+        products = Product.query.all()
+
+        for number in range(count):
+            order = Order(user=admin, total_cost=300, paid=False, charge_id='charge-{}-{}'.format(count, number))
+            order.products = products
+            db.session.add(order)
+
+        db.session.commit()
+
+
+def count_queries(app, client, url):
+
+    queries = []
+
+    def record(_conn, _cursor, statement, *_args):
+        queries.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    assert response.status_code == 200
+
+    return len(queries)
+
+
+def test_order_list_query_count_does_not_grow_with_orders(app, client):
+
+    add_orders(app, 2)
+    few = count_queries(app, client, '/admin/')
+
+    add_orders(app, 18)
+    many = count_queries(app, client, '/admin/')
+
+    assert many == few
+    assert many <= 8
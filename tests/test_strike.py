@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from KaminariMerch.libs.strike import Strike
+
+
+class StubStrike(BaseHTTPRequestHandler):
+
+    # Keep-alive, so connection reuse can be seen from the server's side.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body):
+
+        data = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+
+        server = self.server
+        server.requests.append((self.command, self.path, self.client_address))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        status, body, delay = server.responses.pop(0) if server.responses else (200, {'id': 'ch_1', 'paid': False}, 0)
+
+        if delay:
+            time.sleep(delay)
+
+        try:
+            self._respond(status, body)
+        except OSError:
+            # The client gave up waiting.
+            pass
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+@pytest.fixture
+def stub():
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubStrike)
+    server.daemon_threads = True
+    server.requests = []
+    server.responses = []
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def client_for(server, **options):
+
+    options.setdefault('retry_backoff', 0)
+
+    return Strike('key', endpoint='http://127.0.0.1:{}'.format(server.server_address[1]), **options)
+
+
+def test_get_is_retried_on_503(stub):
+
+    stub.responses = [(503, {}, 0), (503, {}, 0), (200, {'id': 'ch_1', 'paid': True}, 0)]
+
+    charge = client_for(stub, max_retries=3).get_charge('ch_1')
+
+    assert charge == {'id': 'ch_1', 'paid': True}
+    assert [request[0] for request in stub.requests] == ['GET', 'GET', 'GET']
+
+
+def test_post_is_not_retried_on_read_timeout(stub):
+
+    stub.responses = [(200, {'id': 'ch_1'}, 1)]
+
+    charge = client_for(stub, read_timeout=0.2, max_retries=3).create_charge(1000)
+
+    # Anything retried would have arrived while the first request was still sleeping.
+    time.sleep(1.2)
+
+    assert charge is None
+    assert [request[0] for request in stub.requests] == ['POST']
+
+
+def test_read_timeout_returns_none(stub):
+
+    stub.responses = [(200, {'id': 'ch_1'}, 1)]
+
+    started = time.time()
+    charge = client_for(stub, read_timeout=0.2, max_retries=0).get_charge('ch_1')
+
+    assert charge is None
+    assert time.time() - started < 1
+
+
+def test_connections_are_reused(stub):
+
+    client = client_for(stub)
+
+    for _ in range(5):
+        assert client.get_charge('ch_1') is not None
+
+    assert len(stub.requests) == 5
+    assert len(set(address for _, _, address in stub.requests)) == 1